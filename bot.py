@@ -1,18 +1,33 @@
 import os
+import json
+import time
+import queue
+import atexit
 import asyncio
-import traceback
+import logging
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from datetime import datetime, timezone
+from collections import defaultdict, deque
+from functools import lru_cache
+from typing import Dict, DefaultDict, Deque, List, Optional, Any, Set, Tuple
 
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # فقط وقتی REDIS_URL ست شده لازمه
+    aioredis = None
+
+from telegram import Update, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
     MessageHandler, ContextTypes, filters
 )
-from telegram.error import NetworkError
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, NetworkError, RetryAfter
 
 
 # =========================
@@ -26,6 +41,22 @@ BOT_PUBLIC_LINK = "@SBMUchatBot"
 GROUP_ID = -1003614589024
 
 
+# =========================
+# Logging (نوشتن لاگ توی ترد جدا انجام می‌شه)
+# =========================
+log = logging.getLogger("bot")
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+log.propagate = False
+
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
 # =========================
 # Read secrets from env OR files
 # =========================
@@ -59,66 +90,93 @@ if not BOT_TOKEN:
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL not found. Put url in Database.txt or env DATABASE_URL")
 
+# اختیاری: اتصال مستقیم (بدون pooler) برای LISTEN؛ pgbouncer در حالت transaction از LISTEN پشتیبانی نمی‌کنه
+DATABASE_LISTEN_URL = os.environ.get("DATABASE_LISTEN_URL")
+
+# اختیاری: با REDIS_URL وضعیت چت و آپلود بین چند worker مشترک می‌شه
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL and aioredis is None:
+    raise ValueError("REDIS_URL is set but the redis package is not installed")
+
 
 # =========================
 # DB connect + safe helpers
 # =========================
-def db_connect():
-    return psycopg.connect(DATABASE_URL, autocommit=True, row_factory=dict_row)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN") or 4)
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX") or 20)
+DB_PREPARED_MAX = 512
 
 
-db = db_connect()
+async def _configure_conn(conn):
+    # تعداد prepared statement هایی که هر اتصال نگه می‌داره
+    conn.prepared_max = DB_PREPARED_MAX
 
 
-def _run(sql: str, params: tuple = ()):
-    global db
-    try:
-        cur = db.cursor()
-        cur.execute(sql, params)
-        cur.close()
-    except psycopg.OperationalError:
-        db = db_connect()
-        cur = db.cursor()
-        cur.execute(sql, params)
-        cur.close()
+# کوئری‌ها async هستن تا event loop موقع کار دیتابیس قفل نشه
+# (بدون check=: هر checkout یه رفت‌وبرگشت اضافه می‌شد؛ اتصال مرده رو تکرار _with_db جبران می‌کنه)
+db_pool = AsyncConnectionPool(
+    DATABASE_URL,
+    min_size=DB_POOL_MIN,
+    max_size=DB_POOL_MAX,
+    open=False,
+    kwargs={"autocommit": True, "row_factory": dict_row},
+    configure=_configure_conn,
+)
 
 
-def _fetchone(sql: str, params: tuple = ()) -> Optional[dict]:
-    global db
+async def _with_db(op):
     try:
-        cur = db.cursor()
-        cur.execute(sql, params)
-        row = cur.fetchone()
-        cur.close()
-        return row
+        async with db_pool.connection() as conn:
+            return await op(conn)
     except psycopg.OperationalError:
-        db = db_connect()
-        cur = db.cursor()
-        cur.execute(sql, params)
-        row = cur.fetchone()
-        cur.close()
-        return row
+        async with db_pool.connection() as conn:
+            return await op(conn)
 
 
-def _fetchall(sql: str, params: tuple = ()) -> List[dict]:
-    global db
-    try:
-        cur = db.cursor()
-        cur.execute(sql, params)
-        rows = cur.fetchall() or []
-        cur.close()
-        return rows
-    except psycopg.OperationalError:
-        db = db_connect()
-        cur = db.cursor()
-        cur.execute(sql, params)
-        rows = cur.fetchall() or []
-        cur.close()
-        return rows
+# prepare=True برای کوئری‌های پرتکرار: از همون اجرای اول prepared می‌شن، نه بعد از prepare_threshold
+async def _run(sql: str, params: tuple = (), prepare: Optional[bool] = None) -> int:
+    async def op(conn):
+        async with conn.cursor() as cur:
+            await cur.execute(sql, params, prepare=prepare)
+            return cur.rowcount
+    return await _with_db(op)
+
+
+async def _fetchone(sql: str, params: tuple = (), prepare: Optional[bool] = None) -> Optional[dict]:
+    async def op(conn):
+        async with conn.cursor() as cur:
+            await cur.execute(sql, params, prepare=prepare)
+            return await cur.fetchone()
+    return await _with_db(op)
+
 
+async def _fetchall(sql: str, params: tuple = (), prepare: Optional[bool] = None) -> List[dict]:
+    async def op(conn):
+        async with conn.cursor() as cur:
+            await cur.execute(sql, params, prepare=prepare)
+            return await cur.fetchall() or []
+    return await _with_db(op)
 
-def _fetchval(sql: str, params: tuple = (), key: str = None) -> Any:
-    row = _fetchone(sql, params)
+
+async def _runmany(sql: str, params_seq: List[tuple]):
+    async def op(conn):
+        async with conn.cursor() as cur:
+            await cur.executemany(sql, params_seq)
+    await _with_db(op)
+
+
+async def _copy_rows(copy_sql: str, rows: List[tuple]):
+    # COPY ... FROM STDIN: برای نوشتن دسته‌ای ردیف‌ها، یه رفت‌وبرگشت و بدون parse هر INSERT
+    async def op(conn):
+        async with conn.cursor() as cur:
+            async with cur.copy(copy_sql) as copy:
+                for r in rows:
+                    await copy.write_row(r)
+    await _with_db(op)
+
+
+async def _fetchval(sql: str, params: tuple = (), key: str = None, prepare: Optional[bool] = None) -> Any:
+    row = await _fetchone(sql, params, prepare=prepare)
     if not row:
         return None
     if key is not None:
@@ -126,8 +184,8 @@ def _fetchval(sql: str, params: tuple = (), key: str = None) -> Any:
     return next(iter(row.values()))
 
 
-def init_db():
-    _run("""
+async def init_db():
+    await _run("""
     CREATE TABLE IF NOT EXISTS users (
         user_id BIGINT PRIMARY KEY,
         username TEXT,
@@ -139,7 +197,7 @@ def init_db():
         last_seen TIMESTAMPTZ DEFAULT NOW()
     )
     """)
-    _run("""
+    await _run("""
     CREATE TABLE IF NOT EXISTS pending_uploads (
         upload_id BIGSERIAL PRIMARY KEY,
         submitter_id BIGINT NOT NULL,
@@ -154,7 +212,22 @@ def init_db():
         created_at TIMESTAMPTZ DEFAULT NOW()
     )
     """)
-    _run("""
+    await _run("ALTER TABLE pending_uploads ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ")
+    await _run("ALTER TABLE pending_uploads ADD COLUMN IF NOT EXISTS notified_at TIMESTAMPTZ")
+    # هر آپلود جدید یه NOTIFY می‌فرسته؛ اگه کسی LISTEN نکنه هزینه‌ای نداره
+    await _run("""
+    CREATE OR REPLACE FUNCTION notify_pending_new() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('pending_new', NEW.upload_id::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """)
+    await _run("""
+    CREATE OR REPLACE TRIGGER trg_pending_new AFTER INSERT ON pending_uploads
+    FOR EACH ROW EXECUTE FUNCTION notify_pending_new()
+    """)
+    await _run("""
     CREATE TABLE IF NOT EXISTS materials (
         material_id BIGSERIAL PRIMARY KEY,
         faculty TEXT NOT NULL,
@@ -168,15 +241,32 @@ def init_db():
         created_at TIMESTAMPTZ DEFAULT NOW()
     )
     """)
-    _run("CREATE INDEX IF NOT EXISTS idx_materials_search ON materials (faculty, major, course_name)")
-    _run("""
+    await _run("CREATE INDEX IF NOT EXISTS idx_materials_search ON materials (faculty, major, course_name)")
+    await _run(
+        "CREATE INDEX IF NOT EXISTS idx_materials_mid_archive ON materials (material_id) "
+        "INCLUDE (archive_channel_id, archive_message_id)"
+    )
+    # هیچ کوئری‌ای ازش استفاده نمی‌کرد و فقط هزینه‌ی نوشتن داشت؛ روی دیتابیس‌های قبلی پاک می‌شه
+    await _run("DROP INDEX IF EXISTS idx_materials_fm_created")
+    # فقط ردیف‌های باز؛ هم شمارش آمار و هم claim صف بررسی از همین استفاده می‌کنن
+    await _run(
+        "CREATE INDEX IF NOT EXISTS idx_pending_open ON pending_uploads (created_at) "
+        "WHERE status IN ('pending','in_review')"
+    )
+    # جستجوی ILIKE '%...%' روی اسم درس با ایندکس trigram
+    try:
+        await _run("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        await _run("CREATE INDEX IF NOT EXISTS idx_materials_course_trgm ON materials USING gin (course_name gin_trgm_ops)")
+    except psycopg.Error as e:
+        log.warning("pg_trgm not available, course search stays unindexed: %s", e)
+    await _run("""
     CREATE TABLE IF NOT EXISTS user_stats (
         user_id BIGINT PRIMARY KEY,
         approved_uploads INT NOT NULL DEFAULT 0,
         chat_used BOOLEAN NOT NULL DEFAULT FALSE
     )
     """)
-    _run("""
+    await _run("""
     CREATE TABLE IF NOT EXISTS chat_sessions (
         session_id BIGSERIAL PRIMARY KEY,
         user_a BIGINT NOT NULL,
@@ -186,7 +276,7 @@ def init_db():
         status TEXT NOT NULL DEFAULT 'active'
     )
     """)
-    _run("""
+    await _run("""
     CREATE TABLE IF NOT EXISTS chat_messages (
         id BIGSERIAL PRIMARY KEY,
         session_id BIGINT NOT NULL,
@@ -195,7 +285,7 @@ def init_db():
         ts TIMESTAMPTZ DEFAULT NOW()
     )
     """)
-    _run("""
+    await _run("""
     CREATE TABLE IF NOT EXISTS user_broadcasts (
         id BIGSERIAL PRIMARY KEY,
         user_id BIGINT NOT NULL,
@@ -210,13 +300,11 @@ def init_db():
     """)
 
 
-init_db()
-
 
 # =========================
 # Faculties & majors
 # =========================
-FACULTIES = [
+FACULTIES = (
     "دانشکده پزشکی",
     "دانشکده دندان‌پزشکی",
     "دانشکده داروسازی",
@@ -227,22 +315,26 @@ FACULTIES = [
     "دانشکده پرستاری و مامایی",
     "دانشکده فن‌آوری‌های نوین پزشکی",
     "دانشکده طب سنتی",
-]
+)
 
 MAJORS_BY_FACULTY = {
-    "دانشکده پزشکی": ["پزشکی"],
-    "دانشکده دندان‌پزشکی": ["دندان‌پزشکی"],
-    "دانشکده داروسازی": ["داروسازی"],
-    "دانشکده بهداشت و ایمنی": ["بهداشت عمومی", "بهداشت محیط", "مهندسی بهداشت حرفه‌ای و ایمنی", "آموزش بهداشت و ارتقای سلامت"],
-    "دانشکده توانبخشی": ["فیزیوتراپی", "کاردرمانی", "شنوایی‌شناسی", "گفتاردرمانی", "بینایی‌سنجی"],
-    "دانشکده علوم تغذیه": ["علوم تغذیه", "علوم و صنایع غذایی"],
-    "دانشکده پیراپزشکی": ["علوم آزمایشگاهی", "تکنولوژی اتاق عمل", "هوشبری", "فوریت‌های پزشکی", "تکنولوژی پرتوشناسی", "تکنولوژی پرتو درمانی"],
-    "دانشکده پرستاری و مامایی": ["پرستاری", "مامایی"],
-    "دانشکده فن‌آوری‌های نوین پزشکی": ["فناوری اطلاعات سلامت", "مهندسی پزشکی", "فناوری‌های نوین پزشکی"],
-    "دانشکده طب سنتی": ["طب سنتی ایرانی"],
+    "دانشکده پزشکی": ("پزشکی",),
+    "دانشکده دندان‌پزشکی": ("دندان‌پزشکی",),
+    "دانشکده داروسازی": ("داروسازی",),
+    "دانشکده بهداشت و ایمنی": ("بهداشت عمومی", "بهداشت محیط", "مهندسی بهداشت حرفه‌ای و ایمنی", "آموزش بهداشت و ارتقای سلامت"),
+    "دانشکده توانبخشی": ("فیزیوتراپی", "کاردرمانی", "شنوایی‌شناسی", "گفتاردرمانی", "بینایی‌سنجی"),
+    "دانشکده علوم تغذیه": ("علوم تغذیه", "علوم و صنایع غذایی"),
+    "دانشکده پیراپزشکی": ("علوم آزمایشگاهی", "تکنولوژی اتاق عمل", "هوشبری", "فوریت‌های پزشکی", "تکنولوژی پرتوشناسی", "تکنولوژی پرتو درمانی"),
+    "دانشکده پرستاری و مامایی": ("پرستاری", "مامایی"),
+    "دانشکده فن‌آوری‌های نوین پزشکی": ("فناوری اطلاعات سلامت", "مهندسی پزشکی", "فناوری‌های نوین پزشکی"),
+    "دانشکده طب سنتی": ("طب سنتی ایرانی",),
 }
 
-ENTRY_YEARS = [str(y) for y in range(1398, 1411)]
+ENTRY_YEARS = tuple(str(y) for y in range(1398, 1411))
+
+# برای چک سریع ورودی‌های callback_data قبل از رفتن سراغ دیتابیس
+_FACULTY_SET = frozenset(FACULTIES)
+_ENTRY_YEAR_SET = frozenset(ENTRY_YEARS)
 
 
 # =========================
@@ -252,7 +344,10 @@ user_state: Dict[int, str] = {}
 tmp: Dict[int, dict] = {}
 search_state: Dict[int, bool] = {}
 
-waiting_queue: List[int] = []
+# صف انتظار چت: deque برای ترتیب، set برای عضویت/حذف O(1)
+# (حذف از صف تنبل انجامه: فقط از set پاک می‌شه و dequeue ردش می‌کنه)
+waiting_queue: Deque[int] = deque()
+waiting_set: Set[int] = set()
 active_chat: Dict[int, int] = {}
 active_session: Dict[int, int] = {}
 
@@ -260,8 +355,172 @@ admin_broadcast_mode: Dict[int, bool] = {}
 admin_class_filter: Dict[int, Dict[str, str]] = {}
 admin_delete_mode: Dict[int, bool] = {}
 browse_context: Dict[int, Dict[str, int]] = {}
+onboard_state: Dict[int, Dict[str, str]] = {}
 user_broadcast_mode: Dict[int, bool] = {}
 
+# قفل هر کاربر، که دوبار زدن سریع یه دکمه دوتا درخواست موازی نسازه
+# (پاک نمی‌شن: قفلی که آزاد شده ممکنه هنوز منتظر داشته باشه، و هر قفل فقط چند ده بایته)
+_user_locks: DefaultDict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def enqueue_waiting(uid: int):
+    waiting_queue.append(uid)
+    waiting_set.add(uid)
+
+
+def dequeue_partner(exclude: int) -> Optional[int]:
+    while waiting_queue:
+        cand = waiting_queue.popleft()
+        if cand not in waiting_set:
+            continue
+        waiting_set.discard(cand)
+        if cand != exclude and cand not in active_chat:
+            return cand
+    return None
+
+
+def cancel_waiting(uid: int):
+    waiting_set.discard(uid)
+
+
+# =========================
+# Shared state (Redis یا همین dictهای بالا)
+# =========================
+UPLOAD_FLOW_TTL = 3600
+
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+_RK_WAIT_Q = "chat:wait_q"
+_RK_WAIT_SET = "chat:wait_set"
+_RK_PARTNER = "chat:partner"
+_RK_SESSION = "chat:session"
+
+# مثل dequeue_partner/enqueue_waiting ولی اتمیک روی Redis، که دو worker یه نفر رو با هم برندارن؛
+# جفت همین‌جا ثبت می‌شه که طرف مقابل بین بیرون اومدن از صف و ساخته شدن session بی‌صاحب نمونه
+_MATCH_LUA = """
+while true do
+    local cand = redis.call('LPOP', KEYS[1])
+    if not cand then break end
+    if redis.call('SREM', KEYS[2], cand) == 1 and cand ~= ARGV[1]
+       and redis.call('HEXISTS', KEYS[3], cand) == 0 then
+        redis.call('HSET', KEYS[3], ARGV[1], cand, cand, ARGV[1])
+        return cand
+    end
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[2], ARGV[1])
+return false
+"""
+
+# پاک کردن جفت چت به صورت اتمیک؛ اگه طرف مقابل زودتر تموم کرده باشه چیزی برنمی‌گرده
+_END_CHAT_LUA = """
+local partner = redis.call('HGET', KEYS[1], ARGV[1])
+if not partner then return false end
+local sid = redis.call('HGET', KEYS[2], ARGV[1]) or ''
+redis.call('HDEL', KEYS[1], ARGV[1], partner)
+redis.call('HDEL', KEYS[2], ARGV[1], partner)
+return {partner, sid}
+"""
+
+# session فقط وقتی ثبت می‌شه که جفت هنوز سر جاش باشه (کسی وسط INSERT چت رو تموم نکرده باشه)
+_SET_SESSION_LUA = """
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then return 0 end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3], ARGV[2], ARGV[3])
+return 1
+"""
+
+
+async def match_or_enqueue(uid: int) -> Optional[int]:
+    if redis_client is None:
+        partner = dequeue_partner(uid)
+        if partner is None:
+            enqueue_waiting(uid)
+        else:
+            # session_id بعد از INSERT با set_chat_session پر می‌شه
+            active_chat[uid] = partner
+            active_chat[partner] = uid
+        return partner
+    partner = await redis_client.eval(_MATCH_LUA, 3, _RK_WAIT_Q, _RK_WAIT_SET, _RK_PARTNER, uid)
+    return int(partner) if partner else None
+
+
+async def is_waiting(uid: int) -> bool:
+    if redis_client is None:
+        return uid in waiting_set
+    return bool(await redis_client.sismember(_RK_WAIT_SET, uid))
+
+
+async def leave_waiting(uid: int):
+    if redis_client is None:
+        cancel_waiting(uid)
+        return
+    await redis_client.srem(_RK_WAIT_SET, uid)
+
+
+async def get_chat(uid: int) -> Optional[Tuple[int, Optional[int]]]:
+    if redis_client is None:
+        partner = active_chat.get(uid)
+        return None if partner is None else (partner, active_session.get(uid))
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hget(_RK_PARTNER, uid)
+        pipe.hget(_RK_SESSION, uid)
+        partner, sid = await pipe.execute()
+    return None if partner is None else (int(partner), int(sid) if sid else None)
+
+
+async def set_chat_session(uid: int, partner: int, sid: int) -> bool:
+    if redis_client is None:
+        if active_chat.get(uid) != partner:
+            return False
+        active_session[uid] = sid
+        active_session[partner] = sid
+        return True
+    return bool(await redis_client.eval(_SET_SESSION_LUA, 2, _RK_PARTNER, _RK_SESSION, uid, partner, sid))
+
+
+async def pop_chat(uid: int) -> Optional[Tuple[int, Optional[int]]]:
+    if redis_client is None:
+        partner = active_chat.get(uid)
+        if partner is None:
+            return None
+        sid = active_session.get(uid)
+        for u in (uid, partner):
+            active_chat.pop(u, None)
+            active_session.pop(u, None)
+        return partner, sid
+    res = await redis_client.eval(_END_CHAT_LUA, 2, _RK_PARTNER, _RK_SESSION, uid)
+    if not res:
+        return None
+    return int(res[0]), int(res[1]) if res[1] else None
+
+
+async def get_upload_flow(uid: int) -> Optional[Tuple[str, dict]]:
+    if redis_client is None:
+        st = user_state.get(uid)
+        return None if st is None else (st, tmp.setdefault(uid, {}))
+    raw = await redis_client.get(f"flow:{uid}")
+    if raw is None:
+        return None
+    flow = json.loads(raw)
+    return flow["state"], flow["draft"]
+
+
+async def set_upload_flow(uid: int, st: str, draft: dict):
+    if redis_client is None:
+        user_state[uid] = st
+        tmp[uid] = draft
+        return
+    # روی Redis فلوهای نیمه‌کاره بعد از یه ساعت خودشون پاک می‌شن
+    await redis_client.set(f"flow:{uid}", json.dumps({"state": st, "draft": draft}), ex=UPLOAD_FLOW_TTL)
+
+
+async def clear_upload_flow(uid: int):
+    if redis_client is None:
+        user_state.pop(uid, None)
+        tmp.pop(uid, None)
+        return
+    await redis_client.delete(f"flow:{uid}")
+
 
 # =========================
 # Texts
@@ -313,36 +572,102 @@ def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
 
 
-def ensure_stats(uid: int):
-    _run("INSERT INTO user_stats (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (uid,))
+# کش کوتاه‌مدت برای چک‌هایی که تقریباً توی هر کلیک تکرار می‌شن
+CONFIGURED_TTL = 60
+APPROVED_TTL = 300
+_configured_cache: Dict[int, Tuple[float, bool]] = {}
+_approved_cache: Dict[int, Tuple[float, int]] = {}
 
 
-def approved_count(uid: int) -> int:
-    ensure_stats(uid)
-    val = _fetchval("SELECT approved_uploads FROM user_stats WHERE user_id=%s", (uid,), key="approved_uploads")
-    return int(val or 0)
+async def approved_count(uid: int) -> int:
+    now = time.monotonic()
+    hit = _approved_cache.get(uid)
+    if hit and now - hit[0] < APPROVED_TTL:
+        return hit[1]
+    val = await _fetchval(
+        "SELECT approved_uploads FROM user_stats WHERE user_id=%s", (uid,), key="approved_uploads", prepare=True
+    )
+    val = int(val or 0)
+    _approved_cache[uid] = (now, val)
+    return val
 
 
-def badge(uid: int) -> str:
-    return " 🏅جزوه‌یار" if approved_count(uid) >= 1 else ""
+async def badge(uid: int) -> str:
+    return " 🏅جزوه‌یار" if await approved_count(uid) >= 1 else ""
 
 
-def save_user_basic(update: Update):
-    u = update.effective_user
-    _run("""
+# ثبت کاربر + ردیف user_stats در یک دستور
+SAVE_USER_SQL = """
+WITH u AS (
     INSERT INTO users (user_id, username, full_name, last_seen)
     VALUES (%s,%s,%s,NOW())
     ON CONFLICT (user_id) DO UPDATE SET
       username=EXCLUDED.username,
       full_name=EXCLUDED.full_name,
       last_seen=NOW()
-    """, (u.id, u.username, (u.full_name or "").strip()))
-    ensure_stats(u.id)
+    RETURNING user_id
+)
+INSERT INTO user_stats (user_id) SELECT user_id FROM u
+ON CONFLICT (user_id) DO NOTHING
+"""
 
+LAST_SEEN_TTL = 60
+_last_seen_cache: Dict[int, float] = {}
+_last_seen_queue: asyncio.Queue = asyncio.Queue()
 
-def user_configured(uid: int) -> bool:
-    row = _fetchone("SELECT faculty, major, entry_year FROM users WHERE user_id=%s", (uid,))
-    return bool(row and row.get("faculty") and row.get("major") and row.get("entry_year"))
+
+async def save_user_basic(update: Update):
+    u = update.effective_user
+    now = time.monotonic()
+    last = _last_seen_cache.get(u.id)
+    if last is not None and now - last < LAST_SEEN_TTL:
+        return
+
+    params = (u.id, u.username, (u.full_name or "").strip())
+    if last is None:
+        # اولین بار (یا بعد از ری‌استارت): ردیف کاربر باید همین الان ساخته بشه؛
+        # کش بعد از نوشتن پر می‌شه تا آپدیت همزمان بعدی هم تا ساخته شدن ردیف صبر کنه
+        await _run(SAVE_USER_SQL, params, prepare=True)
+    else:
+        _last_seen_queue.put_nowait(params)
+    _last_seen_cache[u.id] = now
+
+
+async def _flush_last_seen(batch: Dict[int, tuple]):
+    while not _last_seen_queue.empty():
+        p = _last_seen_queue.get_nowait()
+        batch[p[0]] = p
+    try:
+        await _runmany(SAVE_USER_SQL, list(batch.values()))
+    except Exception:
+        log.exception("last_seen flush failed")
+
+
+async def last_seen_flusher():
+    batch: Dict[int, tuple] = {}
+    try:
+        while True:
+            first = await _last_seen_queue.get()
+            batch[first[0]] = first
+            await asyncio.sleep(1)
+            await _flush_last_seen(batch)
+            batch = {}
+    except asyncio.CancelledError:
+        # موقع خاموش شدن هرچی مونده رو بنویس
+        if batch or not _last_seen_queue.empty():
+            await _flush_last_seen(batch)
+        raise
+
+
+async def user_configured(uid: int) -> bool:
+    now = time.monotonic()
+    hit = _configured_cache.get(uid)
+    if hit and now - hit[0] < CONFIGURED_TTL:
+        return hit[1]
+    row = await _fetchone("SELECT faculty, major, entry_year FROM users WHERE user_id=%s", (uid,), prepare=True)
+    val = bool(row and row.get("faculty") and row.get("major") and row.get("entry_year"))
+    _configured_cache[uid] = (now, val)
+    return val
 
 
 def format_user_row(row: Optional[dict]) -> str:
@@ -365,38 +690,93 @@ async def delete_after(bot, chat_id: int, message_id: int, delay: int = 7):
 # =========================
 # Keyboards
 # =========================
+# کیبوردهای ثابت یه بار ساخته می‌شن و هر بار همون شیء برمی‌گرده
+_KB_START = InlineKeyboardMarkup([[InlineKeyboardButton("➡️ شروع", callback_data="onboard")]])
+
+_KB_MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔎 جستجوی جزوه / نمونه‌سوال", callback_data="menu_search")],
+    [InlineKeyboardButton("📤 ارسال جزوه / نمونه‌سوال (فقط PDF)", callback_data="menu_upload")],
+    [InlineKeyboardButton("📣 پیام همگانی (بعد از ثبت جزوه)", callback_data="menu_user_bc")],
+    [InlineKeyboardButton("💬 چت با فرد رندوم تو دانشگاه", callback_data="menu_chat")],
+    [InlineKeyboardButton("📣 معرفی به دوستان", callback_data="menu_invite")],
+    [InlineKeyboardButton("👤 پروفایل من", callback_data="menu_profile")],
+])
+
+_KB_ADMIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🗂 جزوه‌های در انتظار تایید", callback_data="admin_pending")],
+    [InlineKeyboardButton("🔎 جستجوی جزوه", callback_data="admin_search_mat")],
+    [InlineKeyboardButton("📊 آمار کاربران", callback_data="admin_stats")],
+    [InlineKeyboardButton("👥 ۱۵ کاربر جدید", callback_data="admin_latest")],
+    [InlineKeyboardButton("🏫 لیست دانشجوها بر اساس کلاس", callback_data="admin_classlist")],
+    [InlineKeyboardButton("💬 ۱۰ چت ناشناس اخیر", callback_data="admin_chats")],
+    [InlineKeyboardButton("📢 پیام همگانی ادمین", callback_data="admin_broadcast")],
+    [InlineKeyboardButton("🗑 حذف جزوه", callback_data="admin_delete")],
+])
+
+_KB_BACK_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")]])
+
+_KB_SEARCH = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📤 ارسال جزوه / نمونه‌سوال (فقط PDF)", callback_data="menu_upload")],
+    [InlineKeyboardButton("🔙 بازگشت", callback_data="back_menu")]
+])
+
+_KB_SEARCH_MODE = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔎 جستجو با اسم درس (کل دانشگاه)", callback_data="search_by_name")],
+    [InlineKeyboardButton("📚 مرور با دکمه‌ها (دانشکده / رشته / درس)", callback_data="search_browse")],
+    [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")],
+])
+
+_KB_BROWSE_EMPTY = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📤 ارسال جزوه / نمونه‌سوال (فقط PDF)", callback_data="menu_upload")],
+    [InlineKeyboardButton("🔙 انتخاب دوباره رشته", callback_data="ser_back_maj")],
+    [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")],
+])
+
+_KB_BROWSE_AGAIN = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 انتخاب جزوه / نمونه‌سوال دیگر", callback_data="search_browse")],
+    [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")],
+])
+
+_KB_CHAT_INTRO = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ بریم!", callback_data="chat_join")],
+    [InlineKeyboardButton("🔙 بازگشت", callback_data="back_menu")]
+])
+
+_KB_CHAT_WAIT = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ لغو انتظار", callback_data="chat_cancel")],
+    [InlineKeyboardButton("🔙 بازگشت", callback_data="back_menu")]
+])
+
+_KB_CHAT_END = InlineKeyboardMarkup([[InlineKeyboardButton("❌ پایان چت", callback_data="chat_end")]])
+
+_KB_IN_CHAT = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ پایان چت", callback_data="chat_end")],
+    [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")]
+])
+
+_KB_CHAT_AGAIN = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💬 چت ناشناس جدید", callback_data="menu_chat")],
+    [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")]
+])
+
+
 def start_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("➡️ شروع", callback_data="onboard")]])
+    return _KB_START
 
 
 def main_menu() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔎 جستجوی جزوه / نمونه‌سوال", callback_data="menu_search")],
-        [InlineKeyboardButton("📤 ارسال جزوه / نمونه‌سوال (فقط PDF)", callback_data="menu_upload")],
-        [InlineKeyboardButton("📣 پیام همگانی (بعد از ثبت جزوه)", callback_data="menu_user_bc")],
-        [InlineKeyboardButton("💬 چت با فرد رندوم تو دانشگاه", callback_data="menu_chat")],
-        [InlineKeyboardButton("📣 معرفی به دوستان", callback_data="menu_invite")],
-        [InlineKeyboardButton("👤 پروفایل من", callback_data="menu_profile")],
-    ])
+    return _KB_MAIN_MENU
 
 
 def admin_menu() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🗂 جزوه‌های در انتظار تایید", callback_data="admin_pending")],
-        [InlineKeyboardButton("🔎 جستجوی جزوه", callback_data="admin_search_mat")],
-        [InlineKeyboardButton("📊 آمار کاربران", callback_data="admin_stats")],
-        [InlineKeyboardButton("👥 ۱۵ کاربر جدید", callback_data="admin_latest")],
-        [InlineKeyboardButton("🏫 لیست دانشجوها بر اساس کلاس", callback_data="admin_classlist")],
-        [InlineKeyboardButton("💬 ۱۰ چت ناشناس اخیر", callback_data="admin_chats")],
-        [InlineKeyboardButton("📢 پیام همگانی ادمین", callback_data="admin_broadcast")],
-        [InlineKeyboardButton("🗑 حذف جزوه", callback_data="admin_delete")],
-    ])
+    return _KB_ADMIN_MENU
 
 
 def back_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")]])
+    return _KB_BACK_MENU
 
 
+@lru_cache(maxsize=None)
 def faculty_kb(prefix: str) -> InlineKeyboardMarkup:
     rows = []
     for idx, f in enumerate(FACULTIES):
@@ -405,8 +785,9 @@ def faculty_kb(prefix: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+@lru_cache(maxsize=None)
 def major_kb(prefix: str, faculty: str) -> InlineKeyboardMarkup:
-    majors = MAJORS_BY_FACULTY.get(faculty, [])
+    majors = MAJORS_BY_FACULTY.get(faculty, ())
     rows = []
     for idx, m in enumerate(majors):
         rows.append([InlineKeyboardButton(m, callback_data=f"{prefix}maj|{idx}")])
@@ -414,6 +795,7 @@ def major_kb(prefix: str, faculty: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+@lru_cache(maxsize=None)
 def year_kb(prefix: str) -> InlineKeyboardMarkup:
     rows = [[InlineKeyboardButton(y, callback_data=f"{prefix}year|{y}")] for y in ENTRY_YEARS]
     rows.append([InlineKeyboardButton("🔙 برگشت", callback_data=f"{prefix}back_maj")])
@@ -421,17 +803,53 @@ def year_kb(prefix: str) -> InlineKeyboardMarkup:
 
 
 def search_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📤 ارسال جزوه / نمونه‌سوال (فقط PDF)", callback_data="menu_upload")],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data="back_menu")]
-    ])
+    return _KB_SEARCH
 
 
 # =========================
 # Admin helpers
 # =========================
+# هر مورد در انتظار فقط به یک ادمین داده می‌شه؛ اگه ۱۰ دقیقه بررسی نشد دوباره قابل برداشتنه
+# اطلاعات ارسال‌کننده همراه ردیف برمی‌گرده که send_pending_to_admin کوئری جدا نزنه
+CLAIM_PENDING_SQL = """
+WITH claimed AS (
+    UPDATE pending_uploads SET status='in_review', claimed_at=NOW()
+    WHERE upload_id = (
+        SELECT upload_id FROM pending_uploads
+        WHERE status='pending'
+           OR (status='in_review' AND claimed_at < NOW() - INTERVAL '10 minutes')
+        ORDER BY created_at ASC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *
+)
+SELECT c.*, u.username, u.full_name
+FROM claimed c
+LEFT JOIN users u ON u.user_id = c.submitter_id
+"""
+
+PENDING_EMPTY_TTL = 30
+_pending_empty_until = 0.0
+
+
+async def claim_next_pending() -> Optional[dict]:
+    global _pending_empty_until
+    if time.monotonic() < _pending_empty_until:
+        return None
+    row = await _fetchone(CLAIM_PENDING_SQL, prepare=True)
+    if not row:
+        _pending_empty_until = time.monotonic() + PENDING_EMPTY_TTL
+    return row
+
+
+def mark_pending_added():
+    global _pending_empty_until
+    _pending_empty_until = 0.0
+
+
 async def send_pending_to_admin(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int, row: dict):
-    user = _fetchone("SELECT user_id, username, full_name FROM users WHERE user_id=%s", (row["submitter_id"],))
+    user = {"user_id": row["submitter_id"], "username": row.get("username"), "full_name": row.get("full_name")}
     prof = row.get("professor_name") or "-"
 
     await context.bot.copy_message(
@@ -455,23 +873,69 @@ async def send_pending_to_admin(context: ContextTypes.DEFAULT_TYPE, admin_chat_i
     )
 
 
+async def notify_admins_pending(context: ContextTypes.DEFAULT_TYPE, row: dict):
+    await asyncio.gather(
+        *(send_pending_to_admin(context, aid, row) for aid in ADMIN_IDS),
+        return_exceptions=True
+    )
+
+
+PENDING_CHANNEL = "pending_new"
+
+# با چند worker همه NOTIFY رو می‌گیرن؛ فقط اونی که notified_at رو ست کنه برای ادمین‌ها می‌فرسته
+NOTIFY_PENDING_SQL = """
+WITH n AS (
+    UPDATE pending_uploads SET notified_at=NOW()
+    WHERE upload_id=%s AND status='pending' AND notified_at IS NULL
+    RETURNING *
+)
+SELECT n.*, u.username, u.full_name
+FROM n
+LEFT JOIN users u ON u.user_id = n.submitter_id
+"""
+
+
+async def pending_listener(app):
+    # app.bot همون چیزیه که send_pending_to_admin از context لازم داره
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(DATABASE_LISTEN_URL, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {PENDING_CHANNEL}")
+                log.info("listening on %s", PENDING_CHANNEL)
+                async for n in conn.notifies():
+                    try:
+                        row = await _fetchone(NOTIFY_PENDING_SQL, (int(n.payload),))
+                        if row:
+                            await notify_admins_pending(app, row)
+                    except Exception:
+                        log.exception("pending notify failed")
+        except psycopg.Error as e:
+            # آپلودهای این فاصله از دکمه «در انتظار تایید» هنوز در دسترسن
+            log.warning("pending listener lost connection, retrying in 5s: %s", e)
+            await asyncio.sleep(5)
+
+
 async def approve_upload(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int, upload_id: int):
-    row = _fetchone("SELECT * FROM pending_uploads WHERE upload_id=%s AND status='pending'", (upload_id,))
+    # اطلاعات ارسال‌کننده هم با همون کوئری میاد (مثل CLAIM_PENDING_SQL)
+    row = await _fetchone("""
+        SELECT p.*, u.user_id, u.username, u.full_name
+        FROM pending_uploads p
+        LEFT JOIN users u ON u.user_id = p.submitter_id
+        WHERE p.upload_id=%s AND p.status IN ('pending','in_review')
+    """, (upload_id,))
     if not row:
         await context.bot.send_message(chat_id=admin_chat_id, text="این مورد قبلاً بررسی شده یا وجود ندارد.")
         return
 
-    submitter = _fetchone("SELECT username, full_name, user_id FROM users WHERE user_id=%s", (row["submitter_id"],))
-
     caption_lines = [
         f"📚 درس: {row['course_name']}",
         f"👨‍🏫 استاد: {row['professor_name'] or '-'}",
         f"🏫 دانشکده: {row['faculty']}",
         f"📌 رشته: {row['major']} - ورودی {row['entry_year']}",
     ]
-    if submitter:
+    if row["user_id"] is not None:
         caption_lines.append(
-            f"👤 ارسال‌کننده: {(submitter.get('full_name') or 'بدون‌نام')} | @{submitter.get('username') or '-'} | {submitter['user_id']}"
+            f"👤 ارسال‌کننده: {(row.get('full_name') or 'بدون‌نام')} | @{row.get('username') or '-'} | {row['user_id']}"
         )
     caption = "\n".join(caption_lines)
 
@@ -482,19 +946,33 @@ async def approve_upload(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int,
         caption=caption
     )
 
-    _run("""
-        INSERT INTO materials (faculty, major, entry_year, course_name, professor_name,
-                               archive_channel_id, archive_message_id, added_by)
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-    """, (row["faculty"], row["major"], row["entry_year"], row["course_name"], row["professor_name"],
-          ARCHIVE_CHANNEL_ID, copied.message_id, row["submitter_id"]))
-
-    _run("UPDATE pending_uploads SET status='approved' WHERE upload_id=%s", (upload_id,))
-    _run("""
+    # ثبت در materials + تغییر وضعیت + شمارنده‌ی کاربر، همه در یک دستور
+    approved = await _run("""
+        WITH upd AS (
+            UPDATE pending_uploads SET status='approved'
+            WHERE upload_id=%s AND status IN ('pending','in_review')
+            RETURNING upload_id
+        ), ins AS (
+            INSERT INTO materials (faculty, major, entry_year, course_name, professor_name,
+                                   archive_channel_id, archive_message_id, added_by)
+            SELECT %s,%s,%s,%s,%s,%s,%s,%s FROM upd
+        )
         INSERT INTO user_stats (user_id, approved_uploads)
-        VALUES (%s, 1)
+        SELECT %s, 1 FROM upd
         ON CONFLICT (user_id) DO UPDATE SET approved_uploads = user_stats.approved_uploads + 1
-    """, (row["submitter_id"],))
+    """, (upload_id,
+          row["faculty"], row["major"], row["entry_year"], row["course_name"], row["professor_name"],
+          ARCHIVE_CHANNEL_ID, copied.message_id, row["submitter_id"],
+          row["submitter_id"]))
+    if not approved:
+        # یه تایید همزمان دیگه زودتر ثبت شده؛ کپی اضافه‌ی آرشیو پاک می‌شه
+        try:
+            await context.bot.delete_message(chat_id=ARCHIVE_CHANNEL_ID, message_id=copied.message_id)
+        except Exception:
+            log.warning("could not delete duplicate archive copy %s", copied.message_id)
+        await context.bot.send_message(chat_id=admin_chat_id, text="این مورد قبلاً بررسی شده یا وجود ندارد.")
+        return
+    _approved_cache.pop(row["submitter_id"], None)
 
     await context.bot.send_message(chat_id=admin_chat_id, text="✅ فایل تایید شد و به آرشیو رفت.")
     try:
@@ -508,11 +986,14 @@ async def approve_upload(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int,
 
 
 async def reject_upload(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int, upload_id: int):
-    row = _fetchone("SELECT * FROM pending_uploads WHERE upload_id=%s AND status='pending'", (upload_id,))
+    row = await _fetchone(
+        "UPDATE pending_uploads SET status='rejected' "
+        "WHERE upload_id=%s AND status IN ('pending','in_review') RETURNING submitter_id",
+        (upload_id,)
+    )
     if not row:
         await context.bot.send_message(chat_id=admin_chat_id, text="این مورد قبلاً بررسی شده یا وجود ندارد.")
         return
-    _run("UPDATE pending_uploads SET status='rejected' WHERE upload_id=%s", (upload_id,))
     await context.bot.send_message(chat_id=admin_chat_id, text="❌ رد شد.")
     try:
         await context.bot.send_message(
@@ -524,34 +1005,247 @@ async def reject_upload(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int,
         pass
 
 
+CLASSLIST_PAGE = 50
+TG_TEXT_LIMIT = 3500
+
+# خط‌ها همون تو Postgres ساخته می‌شن؛ row_number قبل از LIMIT حساب می‌شه پس شماره‌ها سراسری‌ان
+CLASSLIST_SQL = """
+    SELECT string_agg(line, E'\\n' ORDER BY rn) AS body, MAX(total) AS total
+    FROM (
+        SELECT row_number() OVER w AS rn,
+               count(*) OVER () AS total,
+               row_number() OVER w || ') ' || COALESCE(full_name, 'بدون‌نام')
+                   || ' | @' || COALESCE(username, '-') || ' | ' || user_id::text AS line
+        FROM users
+        WHERE faculty=%s AND major=%s AND entry_year=%s
+        WINDOW w AS (ORDER BY full_name NULLS LAST, user_id)
+        ORDER BY full_name NULLS LAST, user_id
+        LIMIT %s OFFSET %s
+    ) t
+"""
+
+
+def split_text(text: str, limit: int = TG_TEXT_LIMIT) -> List[str]:
+    # پیام‌های بلند رو سر خط می‌شکنیم که تلگرام (۴۰۹۶ کاراکتر) چیزی رو نبره
+    chunks, cur, size = [], [], 0
+    for line in text.split("\n"):
+        if cur and size + len(line) + 1 > limit:
+            chunks.append("\n".join(cur))
+            cur, size = [], 0
+        cur.append(line)
+        size += len(line) + 1
+    if cur:
+        chunks.append("\n".join(cur))
+    return chunks
+
+
+async def send_class_list(message: Message, faculty: str, major: str, year: str, offset: int = 0):
+    r = await _fetchone(CLASSLIST_SQL, (faculty, major, year, CLASSLIST_PAGE, offset))
+    if not r or not r["body"]:
+        await message.reply_text(
+            f"هیچ دانشجویی برای این کلاس ثبت نشده:\n{faculty} / {major} / {year}",
+            reply_markup=back_menu_kb()
+        )
+        return
+
+    total = r["total"]
+    text = (
+        f"📋 لیست دانشجوها ({total} نفر):\n"
+        f"{faculty} / {major} / {year}\n\n" +
+        r["body"]
+    )
+
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"cls_page|{max(offset - CLASSLIST_PAGE, 0)}"))
+    if offset + CLASSLIST_PAGE < total:
+        nav.append(InlineKeyboardButton("➡️ بعدی", callback_data=f"cls_page|{offset + CLASSLIST_PAGE}"))
+    kb = InlineKeyboardMarkup([nav, *_KB_BACK_MENU.inline_keyboard]) if nav else _KB_BACK_MENU
+
+    chunks = split_text(text)
+    for chunk in chunks[:-1]:
+        await message.reply_text(chunk)
+    await message.reply_text(chunks[-1], reply_markup=kb)
+
+
 # =========================
-# Anonymous chat end
+# Broadcast helpers
 # =========================
-async def end_chat(context: ContextTypes.DEFAULT_TYPE, uid: int, ended_by: int):
-    if uid in waiting_queue:
-        waiting_queue.remove(uid)
+BROADCAST_CONCURRENCY = 25
+BROADCAST_PAGE = 1000
+# سقف تلگرام حدود ۳۰ پیام در ثانیه‌ست؛ یه کم پایین‌تر می‌مونیم
+BROADCAST_RATE = 25
+BROADCAST_MAX_ATTEMPTS = 5
+
+# تسک‌های run_in_background (پیام همگانی، جواب کال‌بک‌ها)؛ ارجاع نگه داشته می‌شه که وسط کار GC نشن
+_background_tasks = set()
+
+
+async def iter_user_ids(faculty: Optional[str] = None):
+    # صفحه‌به‌صفحه (keyset) تا کل جدول users یک‌جا توی حافظه نیاد
+    last = 0
+    while True:
+        if faculty is None:
+            rows = await _fetchall(
+                "SELECT user_id FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s",
+                (last, BROADCAST_PAGE)
+            )
+        else:
+            rows = await _fetchall(
+                "SELECT user_id FROM users WHERE faculty=%s AND user_id > %s ORDER BY user_id LIMIT %s",
+                (faculty, last, BROADCAST_PAGE)
+            )
+        for r in rows:
+            yield r["user_id"]
+        if len(rows) < BROADCAST_PAGE:
+            return
+        last = rows[-1]["user_id"]
+
+
+async def copy_to_users(bot, user_ids, from_chat_id: int, message_id: int) -> int:
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    # token bucket ساده: هر ارسال یه نوبت به فاصله‌ی 1/BROADCAST_RATE ثانیه می‌گیره
+    pace = asyncio.Lock()
+    next_slot = 0.0
+
+    async def throttle():
+        nonlocal next_slot
+        async with pace:
+            now = time.monotonic()
+            if next_slot > now:
+                await asyncio.sleep(next_slot - now)
+                now = next_slot
+            next_slot = now + 1 / BROADCAST_RATE
+
+    async def one(chat_id: int) -> int:
+        nonlocal next_slot
+        async with sem:
+            for _ in range(BROADCAST_MAX_ATTEMPTS):
+                await throttle()
+                try:
+                    await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
+                    return 1
+                except RetryAfter as e:
+                    # بقیه‌ی ارسال‌ها هم تا تموم شدن flood wait صبر می‌کنن
+                    next_slot = max(next_slot, time.monotonic() + e.retry_after)
+                except Exception:
+                    return 0
+            return 0
+
+    sent = 0
+    batch = []
+    async for chat_id in user_ids:
+        batch.append(chat_id)
+        if len(batch) >= BROADCAST_PAGE:
+            sent += sum(await asyncio.gather(*(one(c) for c in batch)))
+            batch = []
+    if batch:
+        sent += sum(await asyncio.gather(*(one(c) for c in batch)))
+    return sent
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def admin_broadcast_job(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int, message_id: int):
+    try:
+        sent = await copy_to_users(context.bot, iter_user_ids(), admin_chat_id, message_id)
+        await context.bot.send_message(
+            chat_id=admin_chat_id,
+            text=f"✅ پیام همگانی برای حدود {sent} کاربر ارسال شد.",
+            reply_markup=admin_menu()
+        )
+    except Exception:
+        log.exception("admin broadcast failed")
 
-    if uid not in active_chat:
+
+async def user_broadcast_job(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int, row: dict, faculty: str):
+    try:
+        sent = await copy_to_users(
+            context.bot, iter_user_ids(faculty), row["message_chat_id"], row["message_id"]
+        )
+        await context.bot.send_message(
+            chat_id=admin_chat_id,
+            text=f"✅ پیام دانشجو تایید و برای حدود {sent} نفر در دانشکده «{faculty}» ارسال شد."
+        )
+    except Exception:
+        log.exception("user broadcast failed")
         return
 
-    partner = active_chat.get(uid)
-    sid = active_session.get(uid)
+    try:
+        await context.bot.send_message(
+            chat_id=row["user_id"],
+            text="📣 پیام همگانی‌ات توسط ادمین تایید و برای بچه‌های دانشکده‌ات ارسال شد 💙",
+            reply_markup=main_menu()
+        )
+    except Exception:
+        pass
+
+
+# =========================
+# Anonymous chat end
+# =========================
+CHAT_FLUSH_INTERVAL = 0.05
+CHAT_FLUSH_ROWS = 100
+# ts همون لحظه‌ی ارسال پیامه؛ DEFAULT NOW() برای همه‌ی ردیف‌های یه دسته یکی (زمان flush) می‌شد
+COPY_CHAT_MESSAGES_SQL = "COPY chat_messages (session_id, sender_id, msg_text, ts) FROM STDIN"
+
+# پیام‌های چت اول فوروارد می‌شن و بعد دسته‌ای تو دیتابیس ذخیره می‌شن
+_chat_msg_queue: asyncio.Queue = asyncio.Queue()
+
+
+async def _flush_chat_messages(batch: List[tuple]):
+    try:
+        await _copy_rows(COPY_CHAT_MESSAGES_SQL, batch)
+    except Exception:
+        log.exception("chat_messages flush failed (%d rows)", len(batch))
 
-    for u in [uid, partner]:
-        active_chat.pop(u, None)
-        active_session.pop(u, None)
+
+async def chat_message_flusher():
+    loop = asyncio.get_running_loop()
+    batch: List[tuple] = []
+    try:
+        while True:
+            batch.append(await _chat_msg_queue.get())
+            deadline = loop.time() + CHAT_FLUSH_INTERVAL
+            while len(batch) < CHAT_FLUSH_ROWS:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_chat_msg_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await _flush_chat_messages(batch)
+            batch = []
+    except asyncio.CancelledError:
+        # موقع خاموش شدن هرچی مونده رو بنویس
+        while not _chat_msg_queue.empty():
+            batch.append(_chat_msg_queue.get_nowait())
+        if batch:
+            await _flush_chat_messages(batch)
+        raise
+
+
+async def end_chat(context: ContextTypes.DEFAULT_TYPE, uid: int, ended_by: int):
+    await leave_waiting(uid)
+
+    pair = await pop_chat(uid)
+    if pair is None:
+        return
+    partner, sid = pair
 
     if sid:
-        _run("UPDATE chat_sessions SET status='ended', ended_at=NOW() WHERE session_id=%s", (sid,))
+        await _run("UPDATE chat_sessions SET status='ended', ended_at=NOW() WHERE session_id=%s", (sid,))
 
     try:
         await context.bot.send_message(
             chat_id=ended_by,
             text="👋 چت رو تموم کردی.\nاگه دوست داشتی دوباره چت جدید شروع کن 😄",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💬 چت ناشناس جدید", callback_data="menu_chat")],
-                [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")]
-            ])
+            reply_markup=_KB_CHAT_AGAIN
         )
     except Exception:
         pass
@@ -560,692 +1254,756 @@ async def end_chat(context: ContextTypes.DEFAULT_TYPE, uid: int, ended_by: int):
         await context.bot.send_message(
             chat_id=partner,
             text="⚠️ طرف مقابل از چت خارج شد.\nاگه دوست داشتی دوباره چت جدید شروع کن 🙂",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💬 چت ناشناس جدید", callback_data="menu_chat")],
-                [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")]
-            ])
+            reply_markup=_KB_CHAT_AGAIN
         )
     except Exception:
         pass
 
 
 # =========================
-# Handlers
+# Callback handlers
 # =========================
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message:
+async def cb_back_menu(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    if is_admin(uid):
+        await cq.message.reply_text("🛠 پنل ادمین", reply_markup=admin_menu())
         return
-    if update.message.chat.type != "private":
+    if not await user_configured(uid):
+        await cq.message.reply_text("برای شروع فقط چندتا انتخاب ساده داریم 👇", reply_markup=start_kb())
         return
+    await cq.message.reply_text("منوی اصلی 👇", reply_markup=main_menu())
 
-    save_user_basic(update)
-    uid = update.effective_user.id
 
-    if is_admin(uid):
-        await update.message.reply_text("🛠 پنل ادمین", reply_markup=admin_menu())
-        return
+async def cb_menu_invite(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    await cq.message.reply_text(INVITE_TEXT, reply_markup=back_menu_kb())
 
-    if user_configured(uid):
-        await update.message.reply_text("خوش برگشتی 👋", reply_markup=main_menu())
+
+async def cb_onboard(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    await cq.message.reply_text("🎓 اول دانشکده‌ت رو انتخاب کن:", reply_markup=faculty_kb("usr_"))
+
+
+async def cb_usr_fac(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    idx = int(arg)
+    if idx < 0 or idx >= len(FACULTIES):
+        await cq.message.reply_text("یه مشکلی تو انتخاب دانشکده پیش اومد، دوباره تلاش کن.", reply_markup=start_kb())
         return
+    faculty = FACULTIES[idx]
+    onboard_state[uid] = {"faculty": faculty}
+    await cq.message.reply_text("📌 حالا رشته‌ت رو انتخاب کن:", reply_markup=major_kb("usr_", faculty))
 
-    await update.message.reply_text(WELCOME_TEXT, parse_mode="Markdown", reply_markup=start_kb())
 
+async def cb_usr_back_fac(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    await cq.message.reply_text("🎓 اول دانشکده‌ت رو انتخاب کن:", reply_markup=faculty_kb("usr_"))
 
-async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message or update.message.chat.type != "private":
+
+async def cb_usr_maj(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    idx = int(arg)
+    faculty = onboard_state.get(uid, {}).get("faculty")
+    if faculty not in _FACULTY_SET:
+        await cq.message.reply_text("اول دانشکده‌ت رو انتخاب کن:", reply_markup=faculty_kb("usr_"))
         return
-    save_user_basic(update)
-    if not is_admin(update.effective_user.id):
+    majors = MAJORS_BY_FACULTY.get(faculty, ())
+    if idx < 0 or idx >= len(majors):
+        await cq.message.reply_text("یه مشکلی تو انتخاب رشته پیش اومد، دوباره انتخاب کن.", reply_markup=major_kb("usr_", faculty))
         return
-    await update.message.reply_text("🛠 پنل ادمین", reply_markup=admin_menu())
+    major = majors[idx]
+    onboard_state[uid]["major"] = major
+    await cq.message.reply_text("🗓 ورودی‌ت رو انتخاب کن:", reply_markup=year_kb("usr_"))
 
 
-# خوش‌آمدگویی در گروه (با تگ و حذف بعد ۷ ثانیه)
-async def group_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = update.message
-    if not msg:
+async def cb_usr_back_maj(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    faculty = onboard_state.get(uid, {}).get("faculty")
+    if faculty not in _FACULTY_SET:
+        await cq.message.reply_text("🎓 اول دانشکده‌ت رو انتخاب کن:", reply_markup=faculty_kb("usr_"))
         return
+    await cq.message.reply_text("📌 حالا رشته‌ت رو انتخاب کن:", reply_markup=major_kb("usr_", faculty))
 
-    chat = msg.chat
-    if chat.type not in ("group", "supergroup"):
+
+async def cb_usr_year(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    year = arg
+    if year not in _ENTRY_YEAR_SET:
+        await cq.message.reply_text("سال ورودی نامعتبره، دوباره انتخاب کن 🙂", reply_markup=year_kb("usr_"))
         return
-    if chat.id != GROUP_ID:
+    picked = onboard_state.get(uid, {})
+    if not (picked.get("faculty") and picked.get("major")):
+        await cq.message.reply_text("🎓 اول دانشکده‌ت رو انتخاب کن:", reply_markup=faculty_kb("usr_"))
         return
+    # هر سه انتخاب با هم و در یک UPDATE ذخیره می‌شن
+    updated = await _run(
+        "UPDATE users SET faculty=%s, major=%s, entry_year=%s WHERE user_id=%s",
+        (picked["faculty"], picked["major"], year, uid)
+    )
+    onboard_state.pop(uid, None)
+    if updated == 1:
+        _configured_cache[uid] = (time.monotonic(), True)
+    await cq.message.reply_text("✅ آماده‌ای! خوش اومدی 💙\n\nاز اینجا شروع کن 👇", reply_markup=main_menu())
+
+
+async def cb_menu_profile(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    r = await _fetchone("SELECT faculty, major, entry_year FROM users WHERE user_id=%s", (uid,)) or {}
+    ap = await approved_count(uid)
+    await cq.message.reply_text(
+        f"👤 پروفایل تو\n\n🎓 {r.get('faculty','-')}\n📌 {r.get('major','-')}\n🗓 {r.get('entry_year','-')}\n\n"
+        f"🏅 فایل‌های تایید شده (جزوه/نمونه‌سوال): {ap}",
+        reply_markup=back_menu_kb()
+    )
 
-    if not msg.new_chat_members:
+
+async def cb_menu_search(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    if not await user_configured(uid):
+        await cq.message.reply_text("اول دانشکده، رشته و ورودی رو انتخاب کن 🙂", reply_markup=start_kb())
         return
+    await cq.message.reply_text("چطور می‌خوای جزوه / نمونه‌سوال پیدا کنی؟", reply_markup=_KB_SEARCH_MODE)
 
-    for member in msg.new_chat_members:
-        if member.is_bot:
-            continue
-        text = (
-            f"{member.mention_html()} خوش اومدی 🌱\n\n"
-            "این گروه توسط خود دانشجوها اداره می‌شه و هیچ ارتباط رسمی با دانشگاه نداره، پس راحت باش 😊\n\n"
-            f"برای پیدا کردن جزوه / نمونه‌سوال و استفاده از امکانات بیشتر، از ربات استفاده کن: {BOT_PUBLIC_LINK}\n\n"
-            "<b>نکته مهم:</b>\n"
-            "• برای ارسال استیکر در گروه، باید حداقل یک جزوه / نمونه‌سوال تو ربات ثبت و تایید کرده باشی.\n"
-            "• برای ارسال گیف، باید حداقل دو جزوه / نمونه‌سوال تایید شده داشته باشی."
-        )
-        try:
-            sent = await chat.send_message(text=text, parse_mode="HTML")
-            asyncio.create_task(delete_after(context.bot, chat.id, sent.message_id, delay=7))
-        except Exception:
-            pass
 
+async def cb_search_by_name(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    search_state[uid] = True
+    await cq.message.reply_text(
+        "🔎 اسم درس رو بنویس (مثلاً: فیزیولوژی اعتصاب یا کینزیولوژی 2)\n"
+        "جستجو روی **کل جزوه‌ها / نمونه‌سوال‌های دانشگاه** انجام می‌شه.",
+        parse_mode="Markdown",
+        reply_markup=search_kb()
+    )
 
-async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        cq = update.callback_query
-        await cq.answer()
-        uid = cq.from_user.id
-        chat = cq.message.chat
 
-        if chat.type != "private":
-            return
+async def cb_search_browse(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    browse_context[uid] = {}
+    await cq.message.reply_text(
+        "📚 برای پیدا کردن جزوه / نمونه‌سوال با دکمه‌ها، اول دانشکده رو انتخاب کن:",
+        reply_markup=faculty_kb("ser_")
+    )
 
-        save_user_basic(update)
-        data = cq.data
 
-        if data == "back_menu":
-            if is_admin(uid):
-                await cq.message.reply_text("🛠 پنل ادمین", reply_markup=admin_menu())
-                return
-            if not user_configured(uid):
-                await cq.message.reply_text("برای شروع فقط چندتا انتخاب ساده داریم 👇", reply_markup=start_kb())
-                return
-            await cq.message.reply_text("منوی اصلی 👇", reply_markup=main_menu())
-            return
+async def cb_ser_fac(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    idx = int(arg)
+    if idx < 0 or idx >= len(FACULTIES):
+        await cq.message.reply_text("انتخاب دانشکده نامعتبر بود، دوباره امتحان کن.", reply_markup=faculty_kb("ser_"))
+        return
+    faculty = FACULTIES[idx]
+    browse_context.setdefault(uid, {})["faculty_idx"] = idx
+    await cq.message.reply_text(
+        f"📌 حالا رشته‌ی مورد نظر در «{faculty}» رو انتخاب کن:",
+        reply_markup=major_kb("ser_", faculty)
+    )
 
-        if data == "menu_invite":
-            await cq.message.reply_text(INVITE_TEXT, reply_markup=back_menu_kb())
-            return
 
-        if data == "onboard":
-            await cq.message.reply_text("🎓 اول دانشکده‌ت رو انتخاب کن:", reply_markup=faculty_kb("usr_"))
-            return
+async def cb_ser_back_fac(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    await cq.message.reply_text(
+        "📚 دوباره دانشکده رو انتخاب کن:",
+        reply_markup=faculty_kb("ser_")
+    )
 
-        if data.startswith("usr_fac|"):
-            idx = int(data.split("|", 1)[1])
-            if idx < 0 or idx >= len(FACULTIES):
-                await cq.message.reply_text("یه مشکلی تو انتخاب دانشکده پیش اومد، دوباره تلاش کن.", reply_markup=start_kb())
-                return
-            faculty = FACULTIES[idx]
-            _run("UPDATE users SET faculty=%s WHERE user_id=%s", (faculty, uid))
-            await cq.message.reply_text("📌 حالا رشته‌ت رو انتخاب کن:", reply_markup=major_kb("usr_", faculty))
-            return
 
-        if data == "usr_back_fac":
-            await cq.message.reply_text("🎓 اول دانشکده‌ت رو انتخاب کن:", reply_markup=faculty_kb("usr_"))
-            return
+async def cb_ser_maj(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    idx = int(arg)
+    ctx = browse_context.get(uid) or {}
+    f_idx = ctx.get("faculty_idx")
+    if f_idx is None or f_idx < 0 or f_idx >= len(FACULTIES):
+        await cq.message.reply_text("اول دانشکده رو انتخاب کن:", reply_markup=faculty_kb("ser_"))
+        return
+    faculty = FACULTIES[f_idx]
+    majors = MAJORS_BY_FACULTY.get(faculty, ())
+    if idx < 0 or idx >= len(majors):
+        await cq.message.reply_text("انتخاب رشته نامعتبر بود، دوباره انتخاب کن.", reply_markup=major_kb("ser_", faculty))
+        return
+    major = majors[idx]
+    browse_context.setdefault(uid, {})["major_idx"] = idx
+
+    rows = await _fetchall("""
+        SELECT MIN(material_id) AS material_id, course_name, professor_name
+        FROM materials
+        WHERE faculty=%s AND major=%s
+        GROUP BY course_name, professor_name
+        ORDER BY course_name
+    """, (faculty, major))
+
+    if not rows:
+        await cq.message.reply_text(
+            "هنوز جزوه / نمونه‌سوالی برای این رشته ثبت نشده 🙂",
+            reply_markup=_KB_BROWSE_EMPTY
+        )
+        return
 
-        if data.startswith("usr_maj|"):
-            idx = int(data.split("|", 1)[1])
-            row = _fetchone("SELECT faculty FROM users WHERE user_id=%s", (uid,))
-            faculty = row["faculty"] if row and row.get("faculty") else None
-            if not faculty:
-                await cq.message.reply_text("اول دانشکده‌ت رو انتخاب کن:", reply_markup=faculty_kb("usr_"))
-                return
-            majors = MAJORS_BY_FACULTY.get(faculty, [])
-            if idx < 0 or idx >= len(majors):
-                await cq.message.reply_text("یه مشکلی تو انتخاب رشته پیش اومد، دوباره انتخاب کن.", reply_markup=major_kb("usr_", faculty))
-                return
-            major = majors[idx]
-            _run("UPDATE users SET major=%s WHERE user_id=%s", (major, uid))
-            await cq.message.reply_text("🗓 ورودی‌ت رو انتخاب کن:", reply_markup=year_kb("usr_"))
-            return
+    buttons_list = []
+    for r in rows:
+        prof = (r.get("professor_name") or "").strip()
+        title = f"📚 {r['course_name']}"
+        if prof:
+            title += f" — {prof}"
+        buttons_list.append([InlineKeyboardButton(title, callback_data=f"ser_course|{r['material_id']}")])
 
-        if data == "usr_back_maj":
-            row = _fetchone("SELECT faculty FROM users WHERE user_id=%s", (uid,))
-            faculty = row["faculty"] if row and row.get("faculty") else None
-            if not faculty:
-                await cq.message.reply_text("🎓 اول دانشکده‌ت رو انتخاب کن:", reply_markup=faculty_kb("usr_"))
-                return
-            await cq.message.reply_text("📌 حالا رشته‌ت رو انتخاب کن:", reply_markup=major_kb("usr_", faculty))
-            return
+    buttons_list.append([InlineKeyboardButton("🔙 برگشت به انتخاب رشته", callback_data="ser_back_maj")])
+    buttons_list.append([InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")])
 
-        if data.startswith("usr_year|"):
-            year = data.split("|", 1)[1]
-            if year not in ENTRY_YEARS:
-                await cq.message.reply_text("سال ورودی نامعتبره، دوباره انتخاب کن 🙂", reply_markup=year_kb("usr_"))
-                return
-            _run("UPDATE users SET entry_year=%s WHERE user_id=%s", (year, uid))
-            await cq.message.reply_text("✅ آماده‌ای! خوش اومدی 💙\n\nاز اینجا شروع کن 👇", reply_markup=main_menu())
-            return
+    await cq.message.reply_text("درس مورد نظر رو انتخاب کن 👇", reply_markup=InlineKeyboardMarkup(buttons_list))
 
-        if data == "menu_profile":
-            r = _fetchone("SELECT faculty, major, entry_year FROM users WHERE user_id=%s", (uid,)) or {}
-            ap = approved_count(uid)
-            await cq.message.reply_text(
-                f"👤 پروفایل تو\n\n🎓 {r.get('faculty','-')}\n📌 {r.get('major','-')}\n🗓 {r.get('entry_year','-')}\n\n"
-                f"🏅 فایل‌های تایید شده (جزوه/نمونه‌سوال): {ap}",
-                reply_markup=back_menu_kb()
-            )
-            return
 
-        if data == "menu_search":
-            if not user_configured(uid):
-                await cq.message.reply_text("اول دانشکده، رشته و ورودی رو انتخاب کن 🙂", reply_markup=start_kb())
-                return
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔎 جستجو با اسم درس (کل دانشگاه)", callback_data="search_by_name")],
-                [InlineKeyboardButton("📚 مرور با دکمه‌ها (دانشکده / رشته / درس)", callback_data="search_browse")],
-                [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")],
-            ])
-            await cq.message.reply_text("چطور می‌خوای جزوه / نمونه‌سوال پیدا کنی؟", reply_markup=kb)
-            return
+async def cb_ser_back_maj(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    ctx = browse_context.get(uid) or {}
+    f_idx = ctx.get("faculty_idx")
+    if f_idx is None or f_idx < 0 or f_idx >= len(FACULTIES):
+        await cq.message.reply_text("اول دانشکده رو انتخاب کن:", reply_markup=faculty_kb("ser_"))
+        return
+    faculty = FACULTIES[f_idx]
+    await cq.message.reply_text(
+        f"📌 دوباره رشته‌ی مربوط به «{faculty}» رو انتخاب کن:",
+        reply_markup=major_kb("ser_", faculty)
+    )
 
-        if data == "search_by_name":
-            search_state[uid] = True
-            await cq.message.reply_text(
-                "🔎 اسم درس رو بنویس (مثلاً: فیزیولوژی اعتصاب یا کینزیولوژی 2)\n"
-                "جستجو روی **کل جزوه‌ها / نمونه‌سوال‌های دانشگاه** انجام می‌شه.",
-                parse_mode="Markdown",
-                reply_markup=search_kb()
-            )
-            return
 
-        if data == "search_browse":
-            browse_context[uid] = {}
-            await cq.message.reply_text(
-                "📚 برای پیدا کردن جزوه / نمونه‌سوال با دکمه‌ها، اول دانشکده رو انتخاب کن:",
-                reply_markup=faculty_kb("ser_")
-            )
-            return
+async def cb_ser_course(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    mid = int(arg)
+    mat = await _fetchone("SELECT faculty, major, course_name FROM materials WHERE material_id=%s", (mid,))
+    if not mat:
+        await cq.message.reply_text("این فایل دیگر در سیستم وجود ندارد.", reply_markup=back_menu_kb())
+        return
+    rows = await _fetchall(
+        "SELECT archive_channel_id, archive_message_id FROM materials "
+        "WHERE faculty=%s AND major=%s AND course_name=%s ORDER BY created_at DESC",
+        (mat["faculty"], mat["major"], mat["course_name"])
+    )
+    if not rows:
+        await cq.message.reply_text("چیزی برای این درس پیدا نشد.", reply_markup=back_menu_kb())
+        return
 
-        if data.startswith("ser_fac|"):
-            idx = int(data.split("|", 1)[1])
-            if idx < 0 or idx >= len(FACULTIES):
-                await cq.message.reply_text("انتخاب دانشکده نامعتبر بود، دوباره امتحان کن.", reply_markup=faculty_kb("ser_"))
-                return
-            faculty = FACULTIES[idx]
-            browse_context.setdefault(uid, {})["faculty_idx"] = idx
-            await cq.message.reply_text(
-                f"📌 حالا رشته‌ی مورد نظر در «{faculty}» رو انتخاب کن:",
-                reply_markup=major_kb("ser_", faculty)
+    for r in rows:
+        try:
+            await context.bot.copy_message(
+                chat_id=uid,
+                from_chat_id=r["archive_channel_id"],
+                message_id=r["archive_message_id"]
             )
-            return
+        except Exception:
+            pass
 
-        if data == "ser_back_fac":
-            await cq.message.reply_text(
-                "📚 دوباره دانشکده رو انتخاب کن:",
-                reply_markup=faculty_kb("ser_")
-            )
-            return
+    await cq.message.reply_text(
+        "هر وقت خواستی می‌تونی دوباره جزوه / نمونه‌سوال دیگه‌ای انتخاب کنی 👇",
+        reply_markup=_KB_BROWSE_AGAIN
+    )
 
-        if data.startswith("ser_maj|"):
-            idx = int(data.split("|", 1)[1])
-            ctx = browse_context.get(uid) or {}
-            f_idx = ctx.get("faculty_idx")
-            if f_idx is None or f_idx < 0 or f_idx >= len(FACULTIES):
-                await cq.message.reply_text("اول دانشکده رو انتخاب کن:", reply_markup=faculty_kb("ser_"))
-                return
-            faculty = FACULTIES[f_idx]
-            majors = MAJORS_BY_FACULTY.get(faculty, [])
-            if idx < 0 or idx >= len(majors):
-                await cq.message.reply_text("انتخاب رشته نامعتبر بود، دوباره انتخاب کن.", reply_markup=major_kb("ser_", faculty))
-                return
-            major = majors[idx]
-            browse_context.setdefault(uid, {})["major_idx"] = idx
 
-            rows = _fetchall("""
-                SELECT MIN(material_id) AS material_id, course_name, professor_name
-                FROM materials
-                WHERE faculty=%s AND major=%s
-                GROUP BY course_name, professor_name
-                ORDER BY course_name
-            """, (faculty, major))
+async def cb_menu_upload(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    if not await user_configured(uid):
+        await cq.message.reply_text("اول دانشکده، رشته و ورودی رو انتخاب کن 🙂", reply_markup=start_kb())
+        return
+    await set_upload_flow(uid, "await_pdf", {})
+    await cq.message.reply_text(
+        "📤 یه فایل **PDF** از جزوه / نمونه‌سوال رو همینجا بفرست 💙",
+        parse_mode="Markdown",
+        reply_markup=back_menu_kb()
+    )
 
-            if not rows:
-                await cq.message.reply_text(
-                    "هنوز جزوه / نمونه‌سوالی برای این رشته ثبت نشده 🙂",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("📤 ارسال جزوه / نمونه‌سوال (فقط PDF)", callback_data="menu_upload")],
-                        [InlineKeyboardButton("🔙 انتخاب دوباره رشته", callback_data="ser_back_maj")],
-                        [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")],
-                    ])
-                )
-                return
 
-            buttons_list = []
-            for r in rows:
-                prof = (r.get("professor_name") or "").strip()
-                title = f"📚 {r['course_name']}"
-                if prof:
-                    title += f" — {prof}"
-                buttons_list.append([InlineKeyboardButton(title, callback_data=f"ser_course|{r['material_id']}")])
+async def cb_menu_user_bc(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    if not await user_configured(uid):
+        await cq.message.reply_text("اول مشخصات دانشکده‌ات رو کامل کن 🙂", reply_markup=start_kb())
+        return
+    if await approved_count(uid) < 1:
+        await cq.message.reply_text(
+            "برای استفاده از پیام همگانی باید حداقل **یک جزوه / نمونه‌سوال تایید شده** داشته باشی 💙",
+            parse_mode="Markdown",
+            reply_markup=back_menu_kb()
+        )
+        return
+    user_broadcast_mode[uid] = True
+    await cq.message.reply_text(
+        "✍️ پیامی که می‌خوای برای **همه‌ی بچه‌های دانشکده‌ات** ارسال بشه رو بفرست.\n\n"
+        "❗️ اول ادمین متن رو می‌بینه و بعد از تایید، برای همه ارسال می‌شه.",
+        reply_markup=back_menu_kb()
+    )
 
-            buttons_list.append([InlineKeyboardButton("🔙 برگشت به انتخاب رشته", callback_data="ser_back_maj")])
-            buttons_list.append([InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")])
 
-            await cq.message.reply_text("درس مورد نظر رو انتخاب کن 👇", reply_markup=InlineKeyboardMarkup(buttons_list))
-            return
+async def cb_menu_chat(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    if not await user_configured(uid):
+        await cq.message.reply_text("اول دانشکده، رشته و ورودی رو انتخاب کن 🙂", reply_markup=start_kb())
+        return
 
-        if data == "ser_back_maj":
-            ctx = browse_context.get(uid) or {}
-            f_idx = ctx.get("faculty_idx")
-            if f_idx is None or f_idx < 0 or f_idx >= len(FACULTIES):
-                await cq.message.reply_text("اول دانشکده رو انتخاب کن:", reply_markup=faculty_kb("ser_"))
-                return
-            faculty = FACULTIES[f_idx]
-            await cq.message.reply_text(
-                f"📌 دوباره رشته‌ی مربوط به «{faculty}» رو انتخاب کن:",
-                reply_markup=major_kb("ser_", faculty)
-            )
-            return
+    if await get_chat(uid):
+        await cq.message.reply_text("الان توی یه چتی 🙂", reply_markup=_KB_IN_CHAT)
+        return
 
-        if data.startswith("ser_course|"):
-            mid = int(data.split("|", 1)[1])
-            mat = _fetchone("SELECT faculty, major, course_name FROM materials WHERE material_id=%s", (mid,))
-            if not mat:
-                await cq.message.reply_text("این فایل دیگر در سیستم وجود ندارد.", reply_markup=back_menu_kb())
-                return
-            rows = _fetchall(
-                "SELECT archive_channel_id, archive_message_id FROM materials "
-                "WHERE faculty=%s AND major=%s AND course_name=%s ORDER BY created_at DESC",
-                (mat["faculty"], mat["major"], mat["course_name"])
-            )
-            if not rows:
-                await cq.message.reply_text("چیزی برای این درس پیدا نشد.", reply_markup=back_menu_kb())
-                return
+    await cq.message.reply_text(
+        CHAT_INTRO_TEXT,
+        reply_markup=_KB_CHAT_INTRO
+    )
 
-            for r in rows:
-                try:
-                    await context.bot.copy_message(
-                        chat_id=uid,
-                        from_chat_id=r["archive_channel_id"],
-                        message_id=r["archive_message_id"]
-                    )
-                except Exception:
-                    pass
 
-            await cq.message.reply_text(
-                "هر وقت خواستی می‌تونی دوباره جزوه / نمونه‌سوال دیگه‌ای انتخاب کنی 👇",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📚 انتخاب جزوه / نمونه‌سوال دیگر", callback_data="search_browse")],
-                    [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")],
-                ])
-            )
+async def cb_chat_join(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    async with _user_locks[uid]:
+        if await get_chat(uid):
+            return
+        if await is_waiting(uid):
+            await cq.message.reply_text("تو همین الان تو صفی 😄", reply_markup=_KB_CHAT_WAIT)
             return
 
-        if data == "menu_upload":
-            if not user_configured(uid):
-                await cq.message.reply_text("اول دانشکده، رشته و ورودی رو انتخاب کن 🙂", reply_markup=start_kb())
-                return
-            user_state[uid] = "await_pdf"
+        partner = await match_or_enqueue(uid)
+
+        if partner is None:
             await cq.message.reply_text(
-                "📤 یه فایل **PDF** از جزوه / نمونه‌سوال رو همینجا بفرست 💙",
-                parse_mode="Markdown",
-                reply_markup=back_menu_kb()
+                "⏳ منتظریم یه دانشجوی دیگه وصل بشه…",
+                reply_markup=_KB_CHAT_WAIT
             )
             return
 
-        if data == "menu_user_bc":
-            if not user_configured(uid):
-                await cq.message.reply_text("اول مشخصات دانشکده‌ات رو کامل کن 🙂", reply_markup=start_kb())
-                return
-            if approved_count(uid) < 1:
-                await cq.message.reply_text(
-                    "برای استفاده از پیام همگانی باید حداقل **یک جزوه / نمونه‌سوال تایید شده** داشته باشی 💙",
-                    parse_mode="Markdown",
-                    reply_markup=back_menu_kb()
-                )
-                return
-            user_broadcast_mode[uid] = True
-            await cq.message.reply_text(
-                "✍️ پیامی که می‌خوای برای **همه‌ی بچه‌های دانشکده‌ات** ارسال بشه رو بفرست.\n\n"
-                "❗️ اول ادمین متن رو می‌بینه و بعد از تایید، برای همه ارسال می‌شه.",
-                reply_markup=back_menu_kb()
+        sid_row = await _fetchone("""
+            WITH s AS (
+                INSERT INTO chat_sessions (user_a, user_b) VALUES (%s,%s) RETURNING session_id
+            ), u AS (
+                UPDATE user_stats SET chat_used=TRUE WHERE user_id IN (%s,%s)
             )
+            SELECT session_id FROM s
+        """, (uid, partner, uid, partner), prepare=True)
+        sid = sid_row["session_id"]
+        if not await set_chat_session(uid, partner, sid):
+            # یکی از دو نفر وسط ساختن session چت رو تموم کرده
+            await _run("UPDATE chat_sessions SET status='ended', ended_at=NOW() WHERE session_id=%s", (sid,))
             return
 
-        if data == "menu_chat":
-            if not user_configured(uid):
-                await cq.message.reply_text("اول دانشکده، رشته و ورودی رو انتخاب کن 🙂", reply_markup=start_kb())
-                return
+        partner_badge, uid_badge = await asyncio.gather(badge(partner), badge(uid))
+        await context.bot.send_message(
+            chat_id=uid,
+            text=f"🎉 وصل شدی!\n\n👤 ناشناس{partner_badge}",
+            reply_markup=_KB_CHAT_END
+        )
+        await context.bot.send_message(
+            chat_id=partner,
+            text=f"🎉 وصل شدی!\n\n👤 ناشناس{uid_badge}",
+            reply_markup=_KB_CHAT_END
+        )
 
-            _run("UPDATE user_stats SET chat_used=TRUE WHERE user_id=%s", (uid,))
-            if uid in active_chat:
-                await cq.message.reply_text("الان توی یه چتی 🙂", reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ پایان چت", callback_data="chat_end")],
-                    [InlineKeyboardButton("🔙 منوی اصلی", callback_data="back_menu")]
-                ]))
-                return
 
-            await cq.message.reply_text(
-                CHAT_INTRO_TEXT,
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ بریم!", callback_data="chat_join")],
-                    [InlineKeyboardButton("🔙 بازگشت", callback_data="back_menu")]
-                ])
-            )
-            return
+async def cb_chat_cancel(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    async with _user_locks[uid]:
+        await leave_waiting(uid)
+        await cq.message.reply_text("منتظر موندن لغو شد 👌", reply_markup=back_menu_kb())
 
-        if data == "chat_join":
-            if uid in active_chat:
-                return
-            if uid in waiting_queue:
-                await cq.message.reply_text("تو همین الان تو صفی 😄", reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ لغو انتظار", callback_data="chat_cancel")],
-                    [InlineKeyboardButton("🔙 بازگشت", callback_data="back_menu")]
-                ]))
-                return
 
-            partner = None
-            while waiting_queue:
-                cand = waiting_queue.pop(0)
-                if cand != uid and cand not in active_chat:
-                    partner = cand
-                    break
+async def cb_chat_end(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    async with _user_locks[uid]:
+        await end_chat(context, uid, ended_by=uid)
 
-            if partner is None:
-                waiting_queue.append(uid)
-                await cq.message.reply_text(
-                    "⏳ منتظریم یه دانشجوی دیگه وصل بشه…",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ لغو انتظار", callback_data="chat_cancel")],
-                        [InlineKeyboardButton("🔙 بازگشت", callback_data="back_menu")]
-                    ])
-                )
-                return
 
-            sid_row = _fetchone("INSERT INTO chat_sessions (user_a, user_b) VALUES (%s,%s) RETURNING session_id", (uid, partner))
-            sid = sid_row["session_id"]
-            active_chat[uid] = partner
-            active_chat[partner] = uid
-            active_session[uid] = sid
-            active_session[partner] = sid
+async def cb_admin_pending(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    row = await claim_next_pending()
+    if not row:
+        await cq.message.reply_text("فعلاً چیزی برای تایید نداریم ✅", reply_markup=back_menu_kb())
+        return
+    await send_pending_to_admin(context, uid, row)
 
-            await context.bot.send_message(
-                chat_id=uid,
-                text=f"🎉 وصل شدی!\n\n👤 ناشناس{badge(partner)}",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ پایان چت", callback_data="chat_end")]])
-            )
-            await context.bot.send_message(
-                chat_id=partner,
-                text=f"🎉 وصل شدی!\n\n👤 ناشناس{badge(uid)}",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ پایان چت", callback_data="chat_end")]])
-            )
-            return
 
-        if data == "chat_cancel":
-            if uid in waiting_queue:
-                waiting_queue.remove(uid)
-            await cq.message.reply_text("منتظر موندن لغو شد 👌", reply_markup=back_menu_kb())
-            return
+async def cb_appr(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    await approve_upload(context, uid, int(arg))
 
-        if data == "chat_end":
-            await end_chat(context, uid, ended_by=uid)
-            return
 
-        if data == "admin_pending" and is_admin(uid):
-            row = _fetchone("SELECT * FROM pending_uploads WHERE status='pending' ORDER BY created_at ASC LIMIT 1")
-            if not row:
-                await cq.message.reply_text("فعلاً چیزی برای تایید نداریم ✅", reply_markup=back_menu_kb())
-                return
-            await send_pending_to_admin(context, uid, row)
-            return
+async def cb_rej(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    await reject_upload(context, uid, int(arg))
 
-        if data.startswith("appr|") and is_admin(uid):
-            await approve_upload(context, uid, int(data.split("|")[1]))
-            return
 
-        if data.startswith("rej|") and is_admin(uid):
-            await reject_upload(context, uid, int(data.split("|")[1]))
-            return
+async def cb_admin_stats(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    r = await _fetchone("""
+        SELECT
+            (SELECT COUNT(*) FROM users) AS users,
+            (SELECT COUNT(*) FROM materials) AS materials,
+            (SELECT COUNT(*) FROM pending_uploads WHERE status IN ('pending','in_review')) AS pending
+    """)
+    await cq.message.reply_text(
+        f"📊 آمار کلی:\n\n"
+        f"👥 تعداد کاربران: {r['users']}\n"
+        f"📚 فایل‌های تایید شده (جزوه/نمونه‌سوال): {r['materials']}\n"
+        f"⏳ فایل‌های در انتظار تایید: {r['pending']}",
+        reply_markup=back_menu_kb()
+    )
 
-        if data == "admin_stats" and is_admin(uid):
-            cnt_users = _fetchval("SELECT COUNT(*) FROM users", ())
-            cnt_materials = _fetchval("SELECT COUNT(*) FROM materials", ())
-            cnt_pending = _fetchval("SELECT COUNT(*) FROM pending_uploads WHERE status='pending'", ())
-            await cq.message.reply_text(
-                f"📊 آمار کلی:\n\n"
-                f"👥 تعداد کاربران: {cnt_users or 0}\n"
-                f"📚 فایل‌های تایید شده (جزوه/نمونه‌سوال): {cnt_materials or 0}\n"
-                f"⏳ فایل‌های در انتظار تایید: {cnt_pending or 0}",
-                reply_markup=back_menu_kb()
-            )
-            return
 
-        if data == "admin_latest" and is_admin(uid):
-            rows = _fetchall(
-                "SELECT user_id, username, full_name, faculty, major, entry_year, created_at "
-                "FROM users ORDER BY created_at DESC LIMIT 15"
-            )
-            if not rows:
-                await cq.message.reply_text("فعلاً کاربری پیدا نشد.", reply_markup=back_menu_kb())
-                return
-            lines = []
-            for i, r in enumerate(rows, start=1):
-                lines.append(
-                    f"{i}) {r.get('full_name') or 'بدون‌نام'} | @{r.get('username') or '-'} | {r['user_id']}\n"
-                    f"   🎓 {r.get('faculty') or '-'} / {r.get('major') or '-'} / {r.get('entry_year') or '-'}"
-                )
-            await cq.message.reply_text("👥 ۱۵ کاربر اخیر:\n\n" + "\n\n".join(lines), reply_markup=back_menu_kb())
-            return
+async def cb_admin_latest(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    rows = await _fetchall(
+        "SELECT user_id, username, full_name, faculty, major, entry_year, created_at "
+        "FROM users ORDER BY created_at DESC LIMIT 15"
+    )
+    if not rows:
+        await cq.message.reply_text("فعلاً کاربری پیدا نشد.", reply_markup=back_menu_kb())
+        return
+    lines = []
+    for i, r in enumerate(rows, start=1):
+        lines.append(
+            f"{i}) {r.get('full_name') or 'بدون‌نام'} | @{r.get('username') or '-'} | {r['user_id']}\n"
+            f"   🎓 {r.get('faculty') or '-'} / {r.get('major') or '-'} / {r.get('entry_year') or '-'}"
+        )
+    await cq.message.reply_text("👥 ۱۵ کاربر اخیر:\n\n" + "\n\n".join(lines), reply_markup=back_menu_kb())
 
-        if data == "admin_broadcast" and is_admin(uid):
-            admin_broadcast_mode[uid] = True
-            await cq.message.reply_text(
-                "✍️ پیام همگانی ادمین رو بفرست.\n"
-                "همون پیام (هر نوعی) بر اساس همونی که می‌فرستی برای همه کاربران کپی می‌شه.",
-                reply_markup=back_menu_kb()
-            )
-            return
 
-        if data == "admin_delete" and is_admin(uid):
-            admin_delete_mode[uid] = True
-            await cq.message.reply_text(
-                "🗑 آیدی عددی جزوه / نمونه‌سوال رو بفرست تا از دیتابیس حذف بشه.\n"
-                "برای دیدن آیدی، وقتی به عنوان ادمین جزوه‌ها رو جستجو می‌کنی، آیدی کنار هر مورد نمایش داده می‌شه.",
-                reply_markup=back_menu_kb()
-            )
-            return
+async def cb_admin_broadcast(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    admin_broadcast_mode[uid] = True
+    await cq.message.reply_text(
+        "✍️ پیام همگانی ادمین رو بفرست.\n"
+        "همون پیام (هر نوعی) بر اساس همونی که می‌فرستی برای همه کاربران کپی می‌شه.",
+        reply_markup=back_menu_kb()
+    )
 
-        if data == "admin_classlist" and is_admin(uid):
-            admin_class_filter[uid] = {}
-            await cq.message.reply_text("🏫 دانشکده مورد نظر رو انتخاب کن:", reply_markup=faculty_kb("cls_"))
-            return
 
-        if data == "admin_search_mat" and is_admin(uid):
-            search_state[uid] = True
-            await cq.message.reply_text(
-                "🔎 اسم درس رو بنویس تا روی کل جزوه‌ها / نمونه‌سوال‌های دانشگاه جست‌وجو بشه.\n"
-                "برای هر نتیجه، آیدی عددی هم نمایش داده می‌شه.",
-                reply_markup=search_kb()
-            )
-            return
+async def cb_admin_delete(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    admin_delete_mode[uid] = True
+    await cq.message.reply_text(
+        "🗑 آیدی عددی جزوه / نمونه‌سوال رو بفرست تا از دیتابیس حذف بشه.\n"
+        "برای دیدن آیدی، وقتی به عنوان ادمین جزوه‌ها رو جستجو می‌کنی، آیدی کنار هر مورد نمایش داده می‌شه.",
+        reply_markup=back_menu_kb()
+    )
 
-        if data == "admin_chats" and is_admin(uid):
-            sessions = _fetchall(
-                "SELECT session_id, user_a, user_b, started_at, ended_at, status "
-                "FROM chat_sessions ORDER BY started_at DESC LIMIT 10"
-            )
-            if not sessions:
-                await cq.message.reply_text("هنوز هیچ چت ناشناسی ثبت نشده 🌱", reply_markup=back_menu_kb())
-                return
 
-            for s in sessions:
-                ua = _fetchone("SELECT user_id, username, full_name FROM users WHERE user_id=%s", (s["user_a"],))
-                ub = _fetchone("SELECT user_id, username, full_name FROM users WHERE user_id=%s", (s["user_b"],))
-                msgs = _fetchall(
-                    "SELECT sender_id, msg_text, ts FROM chat_messages WHERE session_id=%s ORDER BY ts ASC LIMIT 40",
-                    (s["session_id"],)
-                )
+async def cb_admin_classlist(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    admin_class_filter[uid] = {}
+    await cq.message.reply_text("🏫 دانشکده مورد نظر رو انتخاب کن:", reply_markup=faculty_kb("cls_"))
 
-                header = (
-                    f"🧵 چت ناشناس #{s['session_id']}\n"
-                    f"👤 نفر اول: {format_user_row(ua)}\n"
-                    f"👤 نفر دوم: {format_user_row(ub)}\n"
-                    f"📅 شروع: {s['started_at']}\n"
-                    f"📅 پایان: {s.get('ended_at') or '-'}\n"
-                    f"🔖 وضعیت: {s['status']}\n\n"
-                )
 
-                body_lines = []
-                for m in msgs:
-                    sender = "نفر اول" if ua and m["sender_id"] == ua["user_id"] else "نفر دوم"
-                    body_lines.append(f"{sender}: {m['msg_text']}")
+async def cb_admin_search_mat(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    search_state[uid] = True
+    await cq.message.reply_text(
+        "🔎 اسم درس رو بنویس تا روی کل جزوه‌ها / نمونه‌سوال‌های دانشگاه جست‌وجو بشه.\n"
+        "برای هر نتیجه، آیدی عددی هم نمایش داده می‌شه.",
+        reply_markup=search_kb()
+    )
 
-                text = header + ("\n".join(body_lines) if body_lines else "⏳ هنوز پیامی ثبت نشده.")
-                if len(text) > 3900:
-                    text = text[:3900] + "\n\n… (باقی پیام‌ها طولانی شد و نمایش داده نشد)"
 
-                await cq.message.reply_text(text)
+async def cb_admin_chats(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    sessions = await _fetchall(
+        "SELECT session_id, user_a, user_b, started_at, ended_at, status "
+        "FROM chat_sessions ORDER BY started_at DESC LIMIT 10"
+    )
+    if not sessions:
+        await cq.message.reply_text("هنوز هیچ چت ناشناسی ثبت نشده 🌱", reply_markup=back_menu_kb())
+        return
 
-            await cq.message.reply_text("پایان لیست ۱۰ چت اخیر 👆", reply_markup=back_menu_kb())
-            return
+    for s in sessions:
+        ua = await _fetchone("SELECT user_id, username, full_name FROM users WHERE user_id=%s", (s["user_a"],))
+        ub = await _fetchone("SELECT user_id, username, full_name FROM users WHERE user_id=%s", (s["user_b"],))
+        msgs = await _fetchall(
+            "SELECT sender_id, msg_text, ts FROM chat_messages WHERE session_id=%s ORDER BY ts ASC, id ASC LIMIT 40",
+            (s["session_id"],)
+        )
 
-        if data.startswith("ubappr|") and is_admin(uid):
-            bid = int(data.split("|", 1)[1])
-            row = _fetchone("SELECT * FROM user_broadcasts WHERE id=%s AND status='pending'", (bid,))
-            if not row:
-                await cq.message.reply_text("این پیام قبلاً بررسی شده یا وجود ندارد.", reply_markup=back_menu_kb())
-                return
-            urow = _fetchone("SELECT faculty FROM users WHERE user_id=%s", (row["user_id"],))
-            faculty = row["faculty"] or (urow["faculty"] if urow else None)
-            if not faculty:
-                await cq.message.reply_text("نمی‌توان دانشکده فرستنده را تشخیص داد.", reply_markup=back_menu_kb())
-                return
+        header = (
+            f"🧵 چت ناشناس #{s['session_id']}\n"
+            f"👤 نفر اول: {format_user_row(ua)}\n"
+            f"👤 نفر دوم: {format_user_row(ub)}\n"
+            f"📅 شروع: {s['started_at']}\n"
+            f"📅 پایان: {s.get('ended_at') or '-'}\n"
+            f"🔖 وضعیت: {s['status']}\n\n"
+        )
 
-            users = _fetchall("SELECT user_id FROM users WHERE faculty=%s", (faculty,))
-            sent = 0
-            for r in users:
-                try:
-                    await context.bot.copy_message(
-                        chat_id=r["user_id"],
-                        from_chat_id=row["message_chat_id"],
-                        message_id=row["message_id"]
-                    )
-                    sent += 1
-                except Exception:
-                    pass
+        body_lines = []
+        for m in msgs:
+            sender = "نفر اول" if ua and m["sender_id"] == ua["user_id"] else "نفر دوم"
+            body_lines.append(f"{sender}: {m['msg_text']}")
 
-            _run("UPDATE user_broadcasts SET status='approved' WHERE id=%s", (bid,))
-            await cq.message.reply_text(f"✅ پیام دانشجو تایید و برای حدود {sent} نفر در دانشکده «{faculty}» ارسال شد.")
+        text = header + ("\n".join(body_lines) if body_lines else "⏳ هنوز پیامی ثبت نشده.")
+        if len(text) > 3900:
+            text = text[:3900] + "\n\n… (باقی پیام‌ها طولانی شد و نمایش داده نشد)"
 
-            try:
-                await context.bot.send_message(
-                    chat_id=row["user_id"],
-                    text="📣 پیام همگانی‌ات توسط ادمین تایید و برای بچه‌های دانشکده‌ات ارسال شد 💙",
-                    reply_markup=main_menu()
-                )
-            except Exception:
-                pass
-            return
+        await cq.message.reply_text(text)
 
-        if data.startswith("ubrej|") and is_admin(uid):
-            bid = int(data.split("|", 1)[1])
-            row = _fetchone("SELECT * FROM user_broadcasts WHERE id=%s AND status='pending'", (bid,))
-            if not row:
-                await cq.message.reply_text("این پیام قبلاً بررسی شده یا وجود ندارد.", reply_markup=back_menu_kb())
-                return
-            _run("UPDATE user_broadcasts SET status='rejected' WHERE id=%s", (bid,))
-            await cq.message.reply_text("❌ پیام دانشجو رد شد.", reply_markup=back_menu_kb())
-            try:
-                await context.bot.send_message(
-                    chat_id=row["user_id"],
-                    text="پیام همگانی‌ات توسط ادمین تایید نشد 🌱",
-                    reply_markup=main_menu()
-                )
-            except Exception:
-                pass
-            return
+    await cq.message.reply_text("پایان لیست ۱۰ چت اخیر 👆", reply_markup=back_menu_kb())
 
-        if data.startswith("cls_fac|") and is_admin(uid):
-            idx = int(data.split("|", 1)[1])
-            if idx < 0 or idx >= len(FACULTIES):
-                await cq.message.reply_text("انتخاب دانشکده نامعتبر بود، دوباره امتحان کن.", reply_markup=faculty_kb("cls_"))
-                return
-            faculty = FACULTIES[idx]
-            admin_class_filter.setdefault(uid, {})["faculty"] = faculty
-            await cq.message.reply_text("📌 رشته‌ی مورد نظر رو انتخاب کن:", reply_markup=major_kb("cls_", faculty))
-            return
 
-        if data == "cls_back_fac" and is_admin(uid):
-            await cq.message.reply_text("🏫 دانشکده مورد نظر رو انتخاب کن:", reply_markup=faculty_kb("cls_"))
-            return
+async def cb_ubappr(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    bid = int(arg)
+    # خود UPDATE دروازه‌ست: با دوبار زدن (آپدیت‌های همزمان) فقط یکی ردیف رو برمی‌گردونه
+    row = await _fetchone("""
+        WITH b AS (
+            UPDATE user_broadcasts SET status='approved' WHERE id=%s AND status='pending' RETURNING *
+        )
+        SELECT b.*, COALESCE(b.faculty, u.faculty) AS sender_faculty
+        FROM b
+        LEFT JOIN users u ON u.user_id = b.user_id
+    """, (bid,))
+    if not row:
+        await cq.message.reply_text("این پیام قبلاً بررسی شده یا وجود ندارد.", reply_markup=back_menu_kb())
+        return
+    faculty = row["sender_faculty"]
+    if not faculty:
+        await _run("UPDATE user_broadcasts SET status='pending' WHERE id=%s", (bid,))
+        await cq.message.reply_text("نمی‌توان دانشکده فرستنده را تشخیص داد.", reply_markup=back_menu_kb())
+        return
 
-        if data.startswith("cls_maj|") and is_admin(uid):
-            idx = int(data.split("|", 1)[1])
-            faculty = admin_class_filter.get(uid, {}).get("faculty")
-            if not faculty:
-                await cq.message.reply_text("اول دانشکده را انتخاب کن:", reply_markup=faculty_kb("cls_"))
-                return
-            majors = MAJORS_BY_FACULTY.get(faculty, [])
-            if idx < 0 or idx >= len(majors):
-                await cq.message.reply_text("انتخاب رشته نامعتبر بود، دوباره انتخاب کن.", reply_markup=major_kb("cls_", faculty))
-                return
-            major = majors[idx]
-            admin_class_filter.setdefault(uid, {})["major"] = major
-            await cq.message.reply_text("🗓 سال ورود رو انتخاب کن:", reply_markup=year_kb("cls_"))
-            return
+    await cq.message.reply_text(f"📤 ارسال پیام دانشجو برای دانشکده «{faculty}» شروع شد…")
+    run_in_background(user_broadcast_job(context, uid, row, faculty))
 
-        if data == "cls_back_maj" and is_admin(uid):
-            f = admin_class_filter.get(uid, {}).get("faculty")
-            if not f:
-                await cq.message.reply_text("🏫 دانشکده مورد نظر رو انتخاب کن:", reply_markup=faculty_kb("cls_"))
-                return
-            await cq.message.reply_text("📌 رشته‌ی مورد نظر رو انتخاب کن:", reply_markup=major_kb("cls_", f))
-            return
 
-        if data.startswith("cls_year|") and is_admin(uid):
-            year = data.split("|", 1)[1]
-            fdata = admin_class_filter.get(uid, {})
-            faculty = fdata.get("faculty")
-            major = fdata.get("major")
-            if not (faculty and major):
-                await cq.message.reply_text("یک‌بار دیگه گزینه لیست دانشجوها رو بزن لطفاً.", reply_markup=admin_menu())
-                return
-            rows = _fetchall(
-                "SELECT user_id, username, full_name FROM users "
-                "WHERE faculty=%s AND major=%s AND entry_year=%s "
-                "ORDER BY full_name NULLS LAST, user_id",
-                (faculty, major, year)
-            )
-            if not rows:
-                await cq.message.reply_text(
-                    f"هیچ دانشجویی برای این کلاس ثبت نشده:\n{faculty} / {major} / {year}",
-                    reply_markup=back_menu_kb()
-                )
-                return
+async def cb_ubrej(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    bid = int(arg)
+    row = await _fetchone(
+        "UPDATE user_broadcasts SET status='rejected' WHERE id=%s AND status='pending' RETURNING user_id", (bid,)
+    )
+    if not row:
+        await cq.message.reply_text("این پیام قبلاً بررسی شده یا وجود ندارد.", reply_markup=back_menu_kb())
+        return
+    await cq.message.reply_text("❌ پیام دانشجو رد شد.", reply_markup=back_menu_kb())
+    try:
+        await context.bot.send_message(
+            chat_id=row["user_id"],
+            text="پیام همگانی‌ات توسط ادمین تایید نشد 🌱",
+            reply_markup=main_menu()
+        )
+    except Exception:
+        pass
 
-            lines = []
-            for i, r in enumerate(rows, start=1):
-                lines.append(
-                    f"{i}) {r.get('full_name') or 'بدون‌نام'} | @{r.get('username') or '-'} | {r['user_id']}"
-                )
 
-            text = (
-                f"📋 لیست دانشجوها:\n"
-                f"{faculty} / {major} / {year}\n\n" +
-                "\n".join(lines)
-            )
-            await cq.message.reply_text(text, reply_markup=back_menu_kb())
+async def cb_cls_fac(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    idx = int(arg)
+    if idx < 0 or idx >= len(FACULTIES):
+        await cq.message.reply_text("انتخاب دانشکده نامعتبر بود، دوباره امتحان کن.", reply_markup=faculty_kb("cls_"))
+        return
+    faculty = FACULTIES[idx]
+    admin_class_filter.setdefault(uid, {})["faculty"] = faculty
+    await cq.message.reply_text("📌 رشته‌ی مورد نظر رو انتخاب کن:", reply_markup=major_kb("cls_", faculty))
+
+
+async def cb_cls_back_fac(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    await cq.message.reply_text("🏫 دانشکده مورد نظر رو انتخاب کن:", reply_markup=faculty_kb("cls_"))
+
+
+async def cb_cls_maj(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    idx = int(arg)
+    faculty = admin_class_filter.get(uid, {}).get("faculty")
+    if not faculty:
+        await cq.message.reply_text("اول دانشکده را انتخاب کن:", reply_markup=faculty_kb("cls_"))
+        return
+    majors = MAJORS_BY_FACULTY.get(faculty, ())
+    if idx < 0 or idx >= len(majors):
+        await cq.message.reply_text("انتخاب رشته نامعتبر بود، دوباره انتخاب کن.", reply_markup=major_kb("cls_", faculty))
+        return
+    major = majors[idx]
+    admin_class_filter.setdefault(uid, {})["major"] = major
+    await cq.message.reply_text("🗓 سال ورود رو انتخاب کن:", reply_markup=year_kb("cls_"))
+
+
+async def cb_cls_back_maj(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    f = admin_class_filter.get(uid, {}).get("faculty")
+    if not f:
+        await cq.message.reply_text("🏫 دانشکده مورد نظر رو انتخاب کن:", reply_markup=faculty_kb("cls_"))
+        return
+    await cq.message.reply_text("📌 رشته‌ی مورد نظر رو انتخاب کن:", reply_markup=major_kb("cls_", f))
+
+
+async def cb_cls_year(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    year = arg
+    if year not in _ENTRY_YEAR_SET:
+        await cq.message.reply_text("سال ورود نامعتبر بود، دوباره انتخاب کن.", reply_markup=year_kb("cls_"))
+        return
+    fdata = admin_class_filter.get(uid, {})
+    faculty = fdata.get("faculty")
+    major = fdata.get("major")
+    if not (faculty and major):
+        await cq.message.reply_text("یک‌بار دیگه گزینه لیست دانشجوها رو بزن لطفاً.", reply_markup=admin_menu())
+        return
+    fdata["year"] = year
+    await send_class_list(cq.message, faculty, major, year)
+
+
+async def cb_cls_page(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    fdata = admin_class_filter.get(uid, {})
+    if not all(fdata.get(k) for k in ("faculty", "major", "year")):
+        await cq.message.reply_text("یک‌بار دیگه گزینه لیست دانشجوها رو بزن لطفاً.", reply_markup=admin_menu())
+        return
+    await send_class_list(cq.message, fdata["faculty"], fdata["major"], fdata["year"], max(int(arg), 0))
+
+
+async def cb_get(cq: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, uid: int, arg: str):
+    mid = int(arg)
+    mat = await _fetchone(
+        "SELECT archive_channel_id, archive_message_id FROM materials WHERE material_id=%s", (mid,), prepare=True
+    )
+    if not mat:
+        await cq.message.reply_text("این فایل موجود نیست یا حذف شده.", reply_markup=back_menu_kb())
+        return
+    await context.bot.copy_message(
+        chat_id=uid,
+        from_chat_id=mat["archive_channel_id"],
+        message_id=mat["archive_message_id"]
+    )
+    await cq.message.reply_text("اگه خواستی بازم سرچ کن یا فایل جدید بفرست 👇", reply_markup=search_kb())
+
+
+# callback_data کامل → هندلر
+EXACT_HANDLERS: Dict[str, Any] = {
+    "back_menu": cb_back_menu,
+    "menu_invite": cb_menu_invite,
+    "onboard": cb_onboard,
+    "usr_back_fac": cb_usr_back_fac,
+    "usr_back_maj": cb_usr_back_maj,
+    "menu_profile": cb_menu_profile,
+    "menu_search": cb_menu_search,
+    "search_by_name": cb_search_by_name,
+    "search_browse": cb_search_browse,
+    "ser_back_fac": cb_ser_back_fac,
+    "ser_back_maj": cb_ser_back_maj,
+    "menu_upload": cb_menu_upload,
+    "menu_user_bc": cb_menu_user_bc,
+    "menu_chat": cb_menu_chat,
+    "chat_join": cb_chat_join,
+    "chat_cancel": cb_chat_cancel,
+    "chat_end": cb_chat_end,
+    "admin_pending": cb_admin_pending,
+    "admin_stats": cb_admin_stats,
+    "admin_latest": cb_admin_latest,
+    "admin_broadcast": cb_admin_broadcast,
+    "admin_delete": cb_admin_delete,
+    "admin_classlist": cb_admin_classlist,
+    "admin_search_mat": cb_admin_search_mat,
+    "admin_chats": cb_admin_chats,
+    "cls_back_fac": cb_cls_back_fac,
+    "cls_back_maj": cb_cls_back_maj,
+}
+
+# بخش قبل از | → هندلر
+PREFIX_HANDLERS: Dict[str, Any] = {
+    "usr_fac": cb_usr_fac,
+    "usr_maj": cb_usr_maj,
+    "usr_year": cb_usr_year,
+    "ser_fac": cb_ser_fac,
+    "ser_maj": cb_ser_maj,
+    "ser_course": cb_ser_course,
+    "appr": cb_appr,
+    "rej": cb_rej,
+    "ubappr": cb_ubappr,
+    "ubrej": cb_ubrej,
+    "cls_fac": cb_cls_fac,
+    "cls_maj": cb_cls_maj,
+    "cls_year": cb_cls_year,
+    "cls_page": cb_cls_page,
+    "get": cb_get,
+}
+
+# فقط برای ادمین؛ is_admin یه بار توی buttons چک می‌شه
+ADMIN_ONLY = frozenset({
+    "admin_pending",
+    "appr",
+    "rej",
+    "admin_stats",
+    "admin_latest",
+    "admin_broadcast",
+    "admin_delete",
+    "admin_classlist",
+    "admin_search_mat",
+    "admin_chats",
+    "ubappr",
+    "ubrej",
+    "cls_fac",
+    "cls_back_fac",
+    "cls_maj",
+    "cls_back_maj",
+    "cls_year",
+    "cls_page",
+})
+
+
+# =========================
+# Handlers
+# =========================
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message:
+        return
+    if update.message.chat.type != "private":
+        return
+
+    await save_user_basic(update)
+    uid = update.effective_user.id
+
+    if is_admin(uid):
+        await update.message.reply_text("🛠 پنل ادمین", reply_markup=admin_menu())
+        return
+
+    if await user_configured(uid):
+        await update.message.reply_text("خوش برگشتی 👋", reply_markup=main_menu())
+        return
+
+    await update.message.reply_text(WELCOME_TEXT, parse_mode="Markdown", reply_markup=start_kb())
+
+
+async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message or update.message.chat.type != "private":
+        return
+    await save_user_basic(update)
+    if not is_admin(update.effective_user.id):
+        return
+    await update.message.reply_text("🛠 پنل ادمین", reply_markup=admin_menu())
+
+
+# خوش‌آمدگویی در گروه (با تگ و حذف بعد ۷ ثانیه)
+async def group_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg:
+        return
+
+    chat = msg.chat
+    if chat.type not in ("group", "supergroup"):
+        return
+    if chat.id != GROUP_ID:
+        return
+
+    if not msg.new_chat_members:
+        return
+
+    for member in msg.new_chat_members:
+        if member.is_bot:
+            continue
+        text = (
+            f"{member.mention_html()} خوش اومدی 🌱\n\n"
+            "این گروه توسط خود دانشجوها اداره می‌شه و هیچ ارتباط رسمی با دانشگاه نداره، پس راحت باش 😊\n\n"
+            f"برای پیدا کردن جزوه / نمونه‌سوال و استفاده از امکانات بیشتر، از ربات استفاده کن: {BOT_PUBLIC_LINK}\n\n"
+            "<b>نکته مهم:</b>\n"
+            "• برای ارسال استیکر در گروه، باید حداقل یک جزوه / نمونه‌سوال تو ربات ثبت و تایید کرده باشی.\n"
+            "• برای ارسال گیف، باید حداقل دو جزوه / نمونه‌سوال تایید شده داشته باشی."
+        )
+        try:
+            sent = await chat.send_message(text=text, parse_mode="HTML")
+            asyncio.create_task(delete_after(context.bot, chat.id, sent.message_id, delay=7))
+        except Exception:
+            pass
+
+
+async def answer_quietly(cq: CallbackQuery):
+    try:
+        await cq.answer()
+    except Exception:
+        pass
+
+
+async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        cq = update.callback_query
+        # لودینگ دکمه همزمان با کار هندلر بسته می‌شه، منتظرش نمی‌مونیم
+        run_in_background(answer_quietly(cq))
+        uid = cq.from_user.id
+        chat = cq.message.chat
+
+        if chat.type != "private":
             return
 
-        if data.startswith("get|"):
-            mid = int(data.split("|", 1)[1])
-            mat = _fetchone("SELECT * FROM materials WHERE material_id=%s", (mid,))
-            if not mat:
-                await cq.message.reply_text("این فایل موجود نیست یا حذف شده.", reply_markup=back_menu_kb())
-                return
-            await context.bot.copy_message(
-                chat_id=uid,
-                from_chat_id=mat["archive_channel_id"],
-                message_id=mat["archive_message_id"]
-            )
-            await cq.message.reply_text("اگه خواستی بازم سرچ کن یا فایل جدید بفرست 👇", reply_markup=search_kb())
+        await save_user_basic(update)
+        data = cq.data
+        log.debug("click %s %s", uid, data)
+        tag, _, arg = data.partition("|")
+
+        if data in EXACT_HANDLERS:
+            key, handler = data, EXACT_HANDLERS[data]
+        else:
+            key, handler = tag, PREFIX_HANDLERS.get(tag)
+        if handler and (key not in ADMIN_ONLY or is_admin(uid)):
+            await handler(cq, context, uid, arg)
             return
 
-        if user_configured(uid):
+        if await user_configured(uid):
             await cq.message.reply_text("منوی اصلی 👇", reply_markup=main_menu())
         else:
             await cq.message.reply_text("برای شروع فقط چندتا انتخاب ساده داریم 👇", reply_markup=start_kb())
 
-    except Exception as e:
-        print("❌ ERROR IN buttons():", repr(e))
-        traceback.print_exc()
+    except BadRequest as e:
+        log.warning("buttons bad request: %s", e)
+    except RetryAfter as e:
+        log.warning("buttons flood control, retry after %ss", e.retry_after)
+    except NetworkError:
+        pass
+    except Exception:
+        log.exception("buttons error")
 
 
 async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1258,7 +2016,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = msg.from_user
         uid = user.id
 
-        save_user_basic(update)
+        await save_user_basic(update)
 
         # ========================
         # رفتار مخصوص گروه
@@ -1271,7 +2029,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             # استیکر
             if msg.sticker:
-                if approved_count(uid) < 1:
+                if await approved_count(uid) < 1:
                     try:
                         await msg.delete()
                     except Exception:
@@ -1301,7 +2059,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 is_gif = True
 
             if is_gif:
-                if approved_count(uid) < 2:
+                if await approved_count(uid) < 2:
                     try:
                         await msg.delete()
                     except Exception:
@@ -1334,34 +2092,23 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await msg.reply_text("لطفاً فقط آیدی عددی جزوه / نمونه‌سوال رو بفرست 🙂", reply_markup=admin_menu())
                 return
             mid = int(msg.text.strip())
-            mat = _fetchone("SELECT material_id FROM materials WHERE material_id=%s", (mid,))
+            mat = await _fetchone("SELECT material_id FROM materials WHERE material_id=%s", (mid,))
             if not mat:
                 await msg.reply_text("چنین فایلی پیدا نشد.", reply_markup=admin_menu())
                 return
-            _run("DELETE FROM materials WHERE material_id=%s", (mid,))
+            await _run("DELETE FROM materials WHERE material_id=%s", (mid,))
             await msg.reply_text(f"✅ فایل با آیدی {mid} از دیتابیس حذف شد.", reply_markup=admin_menu())
             return
 
         if uid in admin_broadcast_mode and is_admin(uid):
             admin_broadcast_mode.pop(uid, None)
-            users = _fetchall("SELECT user_id FROM users")
-            sent = 0
-            for row in users:
-                try:
-                    await context.bot.copy_message(
-                        chat_id=row["user_id"],
-                        from_chat_id=msg.chat_id,
-                        message_id=msg.message_id
-                    )
-                    sent += 1
-                except Exception:
-                    pass
-            await msg.reply_text(f"✅ پیام همگانی برای حدود {sent} کاربر ارسال شد.", reply_markup=admin_menu())
+            await msg.reply_text("📤 ارسال پیام همگانی شروع شد…")
+            run_in_background(admin_broadcast_job(context, msg.chat_id, msg.message_id))
             return
 
         if user_broadcast_mode.get(uid):
             user_broadcast_mode[uid] = False
-            if approved_count(uid) < 1:
+            if await approved_count(uid) < 1:
                 await msg.reply_text(
                     "برای استفاده از پیام همگانی باید حداقل یک جزوه / نمونه‌سوال تایید شده داشته باشی 💙",
                     parse_mode="Markdown",
@@ -1369,8 +2116,10 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            uinfo = _fetchone("SELECT faculty, major, entry_year FROM users WHERE user_id=%s", (uid,))
-            row = _fetchone("""
+            uinfo = await _fetchone(
+                "SELECT user_id, username, full_name, faculty, major, entry_year FROM users WHERE user_id=%s", (uid,)
+            )
+            row = await _fetchone("""
                 INSERT INTO user_broadcasts (user_id, faculty, major, entry_year, message_chat_id, message_id)
                 VALUES (%s,%s,%s,%s,%s,%s)
                 RETURNING id
@@ -1383,54 +2132,57 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=main_menu()
             )
 
-            for aid in ADMIN_IDS:
-                try:
-                    await context.bot.copy_message(
-                        chat_id=aid,
-                        from_chat_id=msg.chat_id,
-                        message_id=msg.message_id
-                    )
-                    sender = _fetchone("SELECT user_id, username, full_name, faculty FROM users WHERE user_id=%s", (uid,))
-                    await context.bot.send_message(
-                        chat_id=aid,
-                        text=(
-                            "📣 پیام همگانی جدید از دانشجو\n\n"
-                            f"👤 {format_user_row(sender)}\n"
-                            f"🎓 دانشکده: {sender.get('faculty') if sender else '-'}\n\n"
-                            "تایید یا رد؟"
-                        ),
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("✅ تایید پیام دانشجو", callback_data=f"ubappr|{bid}")],
-                            [InlineKeyboardButton("❌ رد پیام", callback_data=f"ubrej|{bid}")]
-                        ])
-                    )
-                except Exception:
-                    pass
-            return
+            async def notify_admin(aid: int):
+                # اول خود پیام، بعد کارت تایید/رد؛ ترتیب این دو برای ادمین مهمه
+                await context.bot.copy_message(
+                    chat_id=aid,
+                    from_chat_id=msg.chat_id,
+                    message_id=msg.message_id
+                )
+                await context.bot.send_message(
+                    chat_id=aid,
+                    text=(
+                        "📣 پیام همگانی جدید از دانشجو\n\n"
+                        f"👤 {format_user_row(uinfo)}\n"
+                        f"🎓 دانشکده: {uinfo.get('faculty') or '-'}\n\n"
+                        "تایید یا رد؟"
+                    ),
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("✅ تایید پیام دانشجو", callback_data=f"ubappr|{bid}")],
+                        [InlineKeyboardButton("❌ رد پیام", callback_data=f"ubrej|{bid}")]
+                    ])
+                )
 
-        if uid in active_chat:
-            partner = active_chat[uid]
-            sid = active_session.get(uid)
-            if msg.text:
-                _run("INSERT INTO chat_messages (session_id, sender_id, msg_text) VALUES (%s,%s,%s)", (sid, uid, msg.text))
-                await context.bot.send_message(chat_id=partner, text=msg.text)
-            else:
-                await context.bot.send_message(chat_id=partner, text="(فعلاً تو چت ناشناس فقط متن پشتیبانی می‌شه 🙂)")
+            await asyncio.gather(*(notify_admin(aid) for aid in ADMIN_IDS), return_exceptions=True)
             return
 
+        # با concurrent_updates دو پیام پشت سر هم موازی هندل می‌شن؛ قفل ترتیبشون رو نگه می‌داره
+        # (get_chat هم زیر قفله، که روی Redis جواب‌ها جابه‌جا نرسن)
+        async with _user_locks[uid]:
+            pair = await get_chat(uid)
+            if pair:
+                partner, sid = pair
+                if msg.text:
+                    if sid:
+                        _chat_msg_queue.put_nowait((sid, uid, msg.text, datetime.now(timezone.utc)))
+                    await context.bot.send_message(chat_id=partner, text=msg.text)
+                else:
+                    await context.bot.send_message(chat_id=partner, text="(فعلاً تو چت ناشناس فقط متن پشتیبانی می‌شه 🙂)")
+                return
+
         if search_state.get(uid):
             if not msg.text:
                 return
             search_state[uid] = False
             query_text = msg.text.strip()
 
-            rows = _fetchall("""
+            rows = await _fetchall("""
                 SELECT material_id, course_name, professor_name, faculty, major
                 FROM materials
                 WHERE course_name ILIKE %s
                 ORDER BY created_at DESC
                 LIMIT 20
-            """, (f"%{query_text}%",))
+            """, (f"%{query_text}%",), prepare=True)
 
             if not rows:
                 await msg.reply_text("چیزی پیدا نشد 😕", reply_markup=search_kb())
@@ -1453,85 +2205,127 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await msg.reply_text("نتیجه‌ها 👇", reply_markup=InlineKeyboardMarkup(buttons_list))
             return
 
-        st = user_state.get(uid)
-
-        if st == "await_pdf":
-            if not msg.document:
-                await msg.reply_text("فقط فایل **PDF** رو بفرست لطفاً 💙", parse_mode="Markdown", reply_markup=back_menu_kb())
-                return
-            filename = (msg.document.file_name or "").lower()
-            if not filename.endswith(".pdf"):
-                await msg.reply_text("فقط PDF قبول می‌کنیم 🙂", reply_markup=back_menu_kb())
-                return
-
-            u = _fetchone("SELECT faculty, major, entry_year FROM users WHERE user_id=%s", (uid,))
-            tmp[uid] = {
-                "user_chat_id": msg.chat_id,
-                "user_message_id": msg.message_id,
-                "faculty": u["faculty"],
-                "major": u["major"],
-                "entry_year": u["entry_year"],
-            }
-            user_state[uid] = "await_course"
-            await msg.reply_text(COURSE_NAME_TEXT, parse_mode="Markdown", reply_markup=back_menu_kb())
-            return
-
-        if st == "await_course":
-            if not msg.text:
-                return
-            tmp[uid]["course_name"] = msg.text.strip()
-            user_state[uid] = "await_prof"
-            await msg.reply_text("اسم استاد رو هم بنویس (اگه نداری یه خط تیره بفرست) 🙂", reply_markup=back_menu_kb())
-            return
-
-        if st == "await_prof":
-            if not msg.text:
-                return
-            prof = msg.text.strip()
-            if prof in ["-", "—"]:
-                prof = None
+        if await get_upload_flow(uid):
+            async with _user_locks[uid]:
+                st, draft = await get_upload_flow(uid) or (None, {})
+
+                if st == "await_pdf":
+                    if not msg.document:
+                        await msg.reply_text("فقط فایل **PDF** رو بفرست لطفاً 💙", parse_mode="Markdown", reply_markup=back_menu_kb())
+                        return
+                    filename = (msg.document.file_name or "").lower()
+                    if not filename.endswith(".pdf"):
+                        await msg.reply_text("فقط PDF قبول می‌کنیم 🙂", reply_markup=back_menu_kb())
+                        return
+
+                    u = await _fetchone("SELECT faculty, major, entry_year FROM users WHERE user_id=%s", (uid,))
+                    await set_upload_flow(uid, "await_course", {
+                        "user_chat_id": msg.chat_id,
+                        "user_message_id": msg.message_id,
+                        "faculty": u["faculty"],
+                        "major": u["major"],
+                        "entry_year": u["entry_year"],
+                    })
+                    await msg.reply_text(COURSE_NAME_TEXT, parse_mode="Markdown", reply_markup=back_menu_kb())
+                    return
+
+                if st == "await_course":
+                    if not msg.text:
+                        return
+                    draft["course_name"] = msg.text.strip()
+                    await set_upload_flow(uid, "await_prof", draft)
+                    await msg.reply_text("اسم استاد رو هم بنویس (اگه نداری یه خط تیره بفرست) 🙂", reply_markup=back_menu_kb())
+                    return
+
+                if st == "await_prof":
+                    if not msg.text:
+                        return
+                    prof = msg.text.strip()
+                    if prof in ["-", "—"]:
+                        prof = None
+
+                    row = await _fetchone("""
+                        WITH ins AS (
+                            INSERT INTO pending_uploads
+                            (submitter_id, faculty, major, entry_year, course_name, professor_name, user_chat_id, user_message_id)
+                            VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+                            RETURNING *
+                        )
+                        SELECT ins.*, u.username, u.full_name
+                        FROM ins
+                        LEFT JOIN users u ON u.user_id = ins.submitter_id
+                    """, (uid, draft["faculty"], draft["major"], draft["entry_year"], draft["course_name"], prof, draft["user_chat_id"], draft["user_message_id"]))
+                    mark_pending_added()
 
-            data = tmp[uid]
-            row = _fetchone("""
-                INSERT INTO pending_uploads
-                (submitter_id, faculty, major, entry_year, course_name, professor_name, user_chat_id, user_message_id)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                RETURNING upload_id
-            """, (uid, data["faculty"], data["major"], data["entry_year"], data["course_name"], prof, data["user_chat_id"], data["user_message_id"]))
-            upload_id = row["upload_id"]
+                    await clear_upload_flow(uid)
 
-            user_state.pop(uid, None)
-            tmp.pop(uid, None)
+                    await msg.reply_text("📩 فایل‌ت رسید! بعد از تایید ادمین برای بقیه قابل استفاده می‌شه 💙", reply_markup=main_menu())
 
-            await msg.reply_text("📩 فایل‌ت رسید! بعد از تایید ادمین برای بقیه قابل استفاده می‌شه 💙", reply_markup=main_menu())
+                    # با LISTEN، خبر دادن به ادمین‌ها کار pending_listener ـه
+                    if not DATABASE_LISTEN_URL:
+                        await notify_admins_pending(context, row)
+                    return
 
-            for aid in ADMIN_IDS:
-                try:
-                    pend = _fetchone("SELECT * FROM pending_uploads WHERE upload_id=%s", (upload_id,))
-                    await send_pending_to_admin(context, aid, pend)
-                except Exception:
-                    pass
-            return
-
-        if user_configured(uid):
+        if await user_configured(uid):
             await msg.reply_text("از منوی زیر انتخاب کن 👇", reply_markup=main_menu())
         else:
             await msg.reply_text("برای شروع فقط چندتا انتخاب ساده داریم 👇", reply_markup=start_kb())
 
-    except Exception as e:
-        print("❌ ERROR IN on_message():", repr(e))
-        traceback.print_exc()
+    except BadRequest as e:
+        log.warning("on_message bad request: %s", e)
+    except RetryAfter as e:
+        log.warning("on_message flood control, retry after %ss", e.retry_after)
+    except NetworkError:
+        pass
+    except Exception:
+        log.exception("on_message error")
 
 
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     if isinstance(context.error, NetworkError):
         return
-    print("❌ BOT ERROR:", repr(context.error))
-    traceback.print_exc()
+    log.error("bot error", exc_info=context.error)
+
+
+_bg_tasks: List[asyncio.Task] = []
+
+
+async def on_startup(app):
+    await db_pool.open(wait=True)
+    await init_db()
+    _bg_tasks.append(asyncio.create_task(last_seen_flusher()))
+    _bg_tasks.append(asyncio.create_task(chat_message_flusher()))
+    if DATABASE_LISTEN_URL:
+        _bg_tasks.append(asyncio.create_task(pending_listener(app)))
+
+
+async def on_shutdown(app):
+    for t in _bg_tasks:
+        t.cancel()
+    # صبر می‌کنیم تا flusherها قبل از بستن pool کارشون تموم بشه
+    await asyncio.gather(*_bg_tasks, return_exceptions=True)
+    _bg_tasks.clear()
+    await db_pool.close()
+    if redis_client is not None:
+        await redis_client.aclose()
 
 
 def build_application():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # آپدیت‌ها فقط از وبهوک (web.py) میان، پس updater/polling لازم نیست
+        .updater(None)
+        # HTTP/2: همه‌ی sendMessageها روی یه اتصال TLS باز به api.telegram.org مالتی‌پلکس می‌شن (پکیج h2 لازمه)
+        .request(HTTPXRequest(
+            connection_pool_size=256, pool_timeout=5.0,
+            connect_timeout=10.0, read_timeout=20.0, http_version="2",
+        ))
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", admin_cmd))
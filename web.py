@@ -1,92 +1,229 @@
 import os
-import threading
+import re
+import hmac
+import hashlib
 import asyncio
-from flask import Flask, request
+import logging
+import secrets
 
-from telegram import Update
+import orjson
+import uvicorn
+from quart import Quart
+
+try:
+    import uvloop
+except ImportError:  # uvloop روی ویندوز نصب نمی‌شه
+    uvloop = None
+
+from telegram import Bot, Update
 from telegram.ext import Application
 
 PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL") or "https://ni6488295720w-31ma.onrender.com"
 WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH") or "/tg-webhook"
 WEBHOOK_URL = PUBLIC_BASE_URL.rstrip("/") + WEBHOOK_PATH
+# تلگرام این رو تو هدر X-Telegram-Bot-Api-Secret-Token برمی‌گردونه؛ بدون env هر بار بالا اومدن یه مقدار تازه ساخته می‌شه
+# (روی رندر از env میاد که تو deploy همپوشان instance قبلی و جدید یه secret داشته باشن)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# تلگرام فقط A-Z a-z 0-9 _ - قبول می‌کنه؛ مقدار generateValue رندر base64ـه، پس به hex ثابتش تبدیل می‌کنیم
+if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    WEBHOOK_SECRET = hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()
+_WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode()
 
-app = Flask(__name__)
+app = Quart(__name__)
+
+# فرزند لاگر "bot"؛ هندلر صف‌دار (و LOG_LEVEL) رو از bot.py می‌گیره
+log = logging.getLogger("bot.web")
 
 bot_app: Application | None = None
-bot_loop: asyncio.AbstractEventLoop | None = None
+# ارجاع مستقیم برای مسیر webhook، که برای هر آپدیت از bot_app.* رد نشیم
+tg_bot: Bot | None = None
+update_queue: asyncio.Queue | None = None
 
 
 @app.get("/")
-def home():
+async def home():
     return "Bot is running"
 
 
-@app.post(WEBHOOK_PATH)
-def telegram_webhook():
-    global bot_app, bot_loop
-    if bot_app is None or bot_loop is None:
-        return "Bot not ready", 503
+# بات فقط پیام و کال‌بک رو هندل می‌کنه (دستورها، عضو جدید گروه و استیکر هم message هستن)
+ALLOWED_UPDATES = ("message", "callback_query")
 
-    data = request.get_json(force=True, silent=True) or {}
+_SECRET_HEADER = b"x-telegram-bot-api-secret-token"
 
-    try:
-        update = Update.de_json(data, bot_app.bot)
 
-        # ✅ DEBUG: بفهمیم چی داره میاد
-        if update.callback_query:
-            print("📩 INCOMING: callback_query", "data=", update.callback_query.data)
-        elif update.message:
-            print("📩 INCOMING: message", "text=", getattr(update.message, "text", None))
-        else:
-            print("📩 INCOMING: other update type")
+def _plain(status: int, body: bytes):
+    # جواب‌های ثابت به شکل پیام‌های ASGI، یه بار ساخته می‌شن
+    headers = [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(body)).encode())]
+    return (
+        {"type": "http.response.start", "status": status, "headers": headers},
+        {"type": "http.response.body", "body": body},
+    )
 
-        # ✅ مهم‌ترین تغییر: به جای process_update، بنداز داخل صف خود PTB
-        bot_loop.call_soon_threadsafe(bot_app.update_queue.put_nowait, update)
 
-        return "ok", 200
+# تلگرام فقط به status نگاه می‌کنه
+_OK = _plain(200, b"ok")
+_ERROR = _plain(500, b"error")
+_UNAUTHORIZED = _plain(401, b"")
+_NOT_READY = _plain(503, b"Bot not ready")
+_HEALTH = _plain(200, b"OK")
 
-    except Exception as e:
-        print("❌ WEBHOOK ERROR:", repr(e))
-        return f"error: {e}", 500
 
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
 
-def start_bot_background():
-    global bot_app, bot_loop
-    try:
-        bot_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(bot_loop)
 
-        from bot import build_application
-        bot_app = build_application()
+async def telegram_webhook(scope, receive):
+    # قبل از خوندن بدنه، درخواست‌هایی که از تلگرام نیستن رد می‌شن
+    got = b""
+    for name, value in scope["headers"]:
+        if name == _SECRET_HEADER:
+            got = value
+            break
+    if not hmac.compare_digest(got, _WEBHOOK_SECRET_BYTES):
+        return _UNAUTHORIZED
 
-        async def boot():
-            await bot_app.initialize()
-            await bot_app.start()
+    queue = update_queue
+    if queue is None:
+        return _NOT_READY
 
-            await bot_app.bot.delete_webhook(drop_pending_updates=True)
-            ok = await bot_app.bot.set_webhook(
+    try:
+        # orjson مستقیم روی بایت‌های بدنه؛ خیلی سریع‌تر از json استاندارد
+        data = orjson.loads(await _read_body(receive))
+        # نوع‌های دیگه هیچ هندلری ندارن؛ بدون ساختن Update تایید می‌شن
+        if "message" not in data and "callback_query" not in data:
+            return _OK
+        update = Update.de_json(data, tg_bot)
+
+        if log.isEnabledFor(logging.DEBUG):
+            if update.callback_query:
+                log.debug("incoming callback_query data=%s", update.callback_query.data)
+            elif update.message:
+                log.debug("incoming message text=%s", update.message.text)
+            else:
+                log.debug("incoming other update type")
+
+        # وب‌سرور و PTB روی یه event loop هستن، پس مستقیم میره تو صف PTB
+        queue.put_nowait(update)
+
+        return _OK
+
+    except Exception:
+        log.exception("webhook error")
+        return _ERROR
+
+
+# آپدیت‌های نمونه برای گرم کردن مسیر de_json قبل از اولین آپدیت واقعی
+_WARM_USER = {"id": 1, "is_bot": False, "first_name": "warm"}
+_WARM_MESSAGE = {
+    "message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "from": _WARM_USER, "text": "warm",
+    "document": {"file_id": "x", "file_unique_id": "x", "file_name": "warm.pdf"},
+}
+_WARM_UPDATES = (
+    {"update_id": 0, "message": _WARM_MESSAGE},
+    {"update_id": 0, "callback_query": {
+        "id": "0", "chat_instance": "0", "data": "warm", "from": _WARM_USER,
+        "message": dict(_WARM_MESSAGE, reply_markup={
+            "inline_keyboard": [[{"text": "warm", "callback_data": "warm"}]]
+        }),
+    }},
+)
+
+
+def warm_update_parsing(bot: Bot):
+    for data in _WARM_UPDATES:
+        Update.de_json(orjson.loads(orjson.dumps(data)), bot)
+
+
+# webhook و health check رندر قبل از routing کوارت، مستقیم در لایه ASGI جواب داده می‌شن
+def fast_paths(asgi_app):
+    async def wrapper(scope, receive, send):
+        if scope["type"] == "http":
+            path, method = scope["path"], scope["method"]
+            if path == WEBHOOK_PATH and method == "POST":
+                start, body = await telegram_webhook(scope, receive)
+                await send(start)
+                await send(body)
+                return
+            if path == "/healthz" and method in ("GET", "HEAD"):
+                # اگه start_bot شکست خورده باشه رندر باید instance رو ری‌استارت کنه، نه اینکه تو سرویس نگهش داره
+                start, body = _HEALTH if update_queue is not None else _NOT_READY
+                await send(start)
+                await send(body)
+                return
+        await asgi_app(scope, receive, send)
+    return wrapper
+
+
+app.asgi_app = fast_paths(app.asgi_app)
+
+
+# بات روی همون event loop ـی بالا میاد که uvicorn اجرا می‌کنه (lifespan)
+@app.before_serving
+async def start_bot():
+    global bot_app, tg_bot, update_queue
+    try:
+        from bot import build_application
+        # باید uvloop باشه (uvicorn --loop uvloop یا uvloop.run در اجرای محلی)
+        log.info("event loop: %s", type(asyncio.get_running_loop()).__module__)
+        application = build_application()
+
+        await application.initialize()
+        # initialize() خودش post_init رو صدا نمی‌زنه (فقط run_polling/run_webhook)
+        if application.post_init:
+            await application.post_init(application)
+        warm_update_parsing(application.bot)
+        bot_app = application
+        tg_bot = application.bot
+        update_queue = application.update_queue
+
+        # start() و setWebhook به هم وابسته نیستن؛ آپدیت‌های زودرس تو صف می‌مونن تا start تموم شه
+        # (setWebhook با drop_pending_updates خودش آپدیت‌های قبلی رو پاک می‌کنه، deleteWebhook لازم نیست)
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(application.start())
+            set_task = tg.create_task(application.bot.set_webhook(
                 url=WEBHOOK_URL,
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True
-            )
-            wh = await bot_app.bot.get_webhook_info()
-
-            print("🌐 PUBLIC_BASE_URL =", PUBLIC_BASE_URL)
-            print("🌐 WEBHOOK_URL     =", WEBHOOK_URL)
-            print("✅ setWebhook:", ok)
-            print("✅ webhook info url:", wh.url)
-            print("✅ webhook allowed_updates:", wh.allowed_updates)
-
-        bot_loop.run_until_complete(boot())
-        bot_loop.run_forever()
-
-    except Exception as e:
-        print("❌ BOT THREAD FAILED:", repr(e))
+                allowed_updates=list(ALLOWED_UPDATES),
+                drop_pending_updates=True,
+                secret_token=WEBHOOK_SECRET
+            ))
+        ok = set_task.result()
+        wh = await application.bot.get_webhook_info()
+
+        log.info("webhook url=%s set=%s", WEBHOOK_URL, ok)
+        log.info("webhook info url=%s allowed_updates=%s", wh.url, wh.allowed_updates)
+
+    except Exception:
+        log.exception("bot start failed")
+
+
+@app.after_serving
+async def stop_bot():
+    global bot_app, tg_bot, update_queue
+    if bot_app is None:
+        return
+    application, bot_app = bot_app, None
+    tg_bot = update_queue = None
+    await application.stop()
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def main():
+    # برای اجرای محلی؛ روی Render مستقیم با `uvicorn web:app` اجرا می‌شه
+    port = int(os.environ.get("PORT", 10000))
+    # همون تنظیمات startCommand رندر؛ لاگ دسترسی برای هر آپدیت تلگرام یه خط اضافه می‌نوشت
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=port, http="httptools", access_log=False))
+    await server.serve()
 
 
 if __name__ == "__main__":
-    t = threading.Thread(target=start_bot_background, daemon=True)
-    t.start()
-
-    port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())